@@ -9,17 +9,20 @@
 # inp_qc = *stat file output by qualtool
 # inp_dup = *.dat output picard mark duplicates
 # inp_hs = *Metricsfile.txt outoput by Picard CalculateHsMetrics 
+# The Picard metrics are parsed by picard_metrics, which caches them in
+# the file named by PICARD_METRICS_CACHE, if set.
 
 import sys
 
+import picard_metrics
+
 if len(sys.argv) < 5:
     print >>sys.stderr, "Commandline arguments missing:\nFormat: aggregate_CGA_stats.py OUT INP_QC INP_DUP INP_HS\nout = output file\ninp_qc = *stat file output by qualtool\ninp_dup = *.dat output by Picard MarkDuplicates\ninp_hs = *Metricsfile.txt outoput by Picard CalculateHsMetrics"
     sys.exit()
     
 out = open(sys.argv[1],"w")
 inp_qc  = open(sys.argv[2],"r")
-inp_dup = open(sys.argv[3],"r")
-inp_hs  = open(sys.argv[4],"r")
+cache = picard_metrics.default_cache()
 
 qc_out = [None, None]
 read_data = False
@@ -50,37 +53,16 @@ for line in inp_qc:
                 qc_out[1] = "NA"
 print >>out, "Total number of reads\t%s\nTotal number of HQ filtered reads\t%s" %(qc_out[0],qc_out[1])
 
-data_lines_dup = []
-for line in inp_dup:
-    line = line.strip()
-    if line and not(line.startswith("#")):
-        data_lines_dup.append(line)
-
-col_names = data_lines_dup[0].split("\t")
-col_values = data_lines_dup[1].split("\t")
-for i,n in enumerate(col_names):
+dup = picard_metrics.read_metrics(sys.argv[3], cache)
+for n in dup.header:
         if n in ["PERCENT_DUPLICATION"]:
-            print >>out, "%s\t%s" %(n,col_values[i])
-
-data_lines = []
-for line in inp_hs:
-    line = line.strip()
+            print >>out, "%s\t%s" %(n,dup.raw(n))
 
-    if line and not(line.startswith("#")):
-        data_lines.append(line)
-        print(line)
-
-print(len(data_lines))
-#if len(data_lines) != 2:
-#    print >>sys.stderr, "CoverageMetrics.txt is invalid"
-#else:
-
-col_names = data_lines[0].split("\t")
-col_values = data_lines[1].split("\t")
-
-for i,n in enumerate(col_names):
+hs = picard_metrics.read_metrics(sys.argv[4], cache)
+for n in hs.header:
     if n in ["PF_UNIQUE_READS", "PCT_PF_UQ_READS_ALIGNED", "PCT_SELECTED_BASES", "MEAN_TARGET_COVERAGE"] or n.startswith("PCT_TARGET_BASES"):
-        print >>out, "%s\t%s" %(n,col_values[i])
-        print("%s \t %s" % (n, col_values[i]))
-
+        print >>out, "%s\t%s" %(n,hs.raw(n))
+        print("%s \t %s" % (n, hs.raw(n)))
 
+if cache is not None and cache.changed:
+    cache.save()
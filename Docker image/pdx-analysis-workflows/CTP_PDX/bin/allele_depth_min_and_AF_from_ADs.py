@@ -16,7 +16,32 @@ Add them together and compare to the required minimum depth.
 If greater or equal, output the line as-is.
 If less, change the FILTER column value to MinDP and output the line.
 
+Each ALT allele of a record is output on a line of its own, with its
+ALT_AF, and the AD of the reference and that allele only.
+
+Records are rewritten by rewrite_record(), which splits only the
+columns it changes.  The position of AD in each distinct FORMAT string
+is looked up once and cached, and the output is written in large
+blocks.
+
+The input may be plain or gzip/BGZF compressed (.vcf.gz), recognized
+by its first bytes.  With --bgzip, or an output name ending in .gz,
+the output is BGZF compressed by bgzip, and with --index it is also
+indexed by tabix (the records must then be sorted by position).
+
+With --workers N, the records are rewritten by N processes.  A plain
+VCF is split into byte ranges ending at line ends, which the workers
+read themselves; a compressed one is decompressed here and handed out
+in blocks of lines.  The results are written in the input order, after
+the header, as without --workers.
+
 """
+import argparse
+import collections
+import gzip
+import multiprocessing
+import os
+import subprocess
 import sys
 
 # Check for a version request.
@@ -28,55 +53,74 @@ INFO_CELL_INDEX = 7
 FORMAT_CELL_INDEX = 8
 SAMPLE_DATA_INDEX = 9
 
-# expecting sys.argv to look something like
-if len(sys.argv) != 4:
-    print ("Incorrect number of args!")
-    print ("expected usage:")
-    print ("allele_depth_min_and_AF_from_ADs.py inputFile outputFile minDP")
-    raise Exception("Incorrect number of args!")
-
-inp = open(sys.argv[1], 'r')
-out = open(sys.argv[2], 'w')
-minimumTotalAlleleDepth = int(sys.argv[3])
-
-NEW_INFO_HEADERS = ['##INFO=<ID=ALT_AF,Number=A,Type=Float,'
-                    'Description="Estimated Allele Frequency, '
-                    'for each ALT allele, in the same order as '
-                    'listed">',
-                    '##INFO=<ID=DP_HQ,Number=1,Type=Integer,'
-                    'Description="HQ Read depth; sum of allelic '
-                    'depths">',
-                    '##FILTER=<ID=minDP,Description="DP_HQ < %s">' %minimumTotalAlleleDepth]
-vcf_headers = []
-for line in inp:
-    line = line.strip()
-    if line.startswith("#"):
-        vcf_headers.append(line)
-        # adding new info headers just before the #CHROM line
-        if line.startswith("#CHROM"):
-            # remove any existing INFO headers for DP_HQ and ALT_AF
-            vcf_headers = [e for e in vcf_headers if
-                           "##INFO=<ID=DP_HQ" not in e]
-            vcf_headers = [e for e in vcf_headers if
-                           "##INFO=<ID=ALT_AF" not in e]
-            vcf_headers = [e for e in vcf_headers if
-                           "##FILTER=<ID=minDP" not in e]
-            # add the new DP_HQ and ALT_AF INFO headers just before
-            # the #CHROM line
-            for e in NEW_INFO_HEADERS:
-                vcf_headers.insert(-1, e)
-            # write out all the headers
-            for e in vcf_headers:
-                print (e, file=out)
-        continue
-    elems = line.split("\t")
-    info = elems[INFO_CELL_INDEX]
-    formatTokens = elems[FORMAT_CELL_INDEX].split(":")
-    alleleDepthIndex = formatTokens.index('AD')
-    ads = elems[SAMPLE_DATA_INDEX].split(":")[alleleDepthIndex].\
-        split(',')
-    for a, ad in enumerate(ads):
-        ads[a] = int(ad)
+# Output buffer size.
+BUFFER_SIZE = 1024 * 1024
+
+# The work given to a worker at a time: bytes of a plain VCF, or lines
+# of a compressed one.
+RANGE_SIZE = 4 * 1024 * 1024
+BLOCK_LINES = 20000
+
+
+def new_info_headers(minimumTotalAlleleDepth):
+    return ['##INFO=<ID=ALT_AF,Number=A,Type=Float,'
+            'Description="Estimated Allele Frequency, '
+            'for each ALT allele, in the same order as '
+            'listed">',
+            '##INFO=<ID=DP_HQ,Number=1,Type=Integer,'
+            'Description="HQ Read depth; sum of allelic '
+            'depths">',
+            '##FILTER=<ID=minDP,Description="DP_HQ < %s">'
+            % minimumTotalAlleleDepth]
+
+
+def rewrite_headers(vcf_headers, minimumTotalAlleleDepth):
+    """
+    :param vcf_headers: The header lines, up to and including #CHROM.
+    :return: The header lines, with the DP_HQ, ALT_AF and minDP headers
+    replaced by new ones just before the #CHROM line.
+    """
+    # remove any existing INFO headers for DP_HQ and ALT_AF
+    vcf_headers = [e for e in vcf_headers if
+                   "##INFO=<ID=DP_HQ" not in e and
+                   "##INFO=<ID=ALT_AF" not in e and
+                   "##FILTER=<ID=minDP" not in e]
+    # add the new DP_HQ and ALT_AF INFO headers just before
+    # the #CHROM line
+    for e in new_info_headers(minimumTotalAlleleDepth):
+        vcf_headers.insert(-1, e)
+    return vcf_headers
+
+
+class FormatCache(dict):
+    """
+    The index of AD in each FORMAT string; most VCFs have only a few
+    distinct ones.
+    """
+    def __missing__(self, format_cell):
+        alleleDepthIndex = format_cell.split(":").index('AD')
+        self[format_cell] = alleleDepthIndex
+        return alleleDepthIndex
+
+    # End of class FormatCache.
+
+
+def rewrite_record(line, minimumTotalAlleleDepth, ad_indexes):
+    """
+    Recompute the depth of a record from its allele depths, filter it
+    on the minimum depth, and split it into one line per ALT allele.
+
+    :param line: The record, without its line end.
+    :param minimumTotalAlleleDepth: The minDP threshold.
+    :param ad_indexes: A FormatCache.
+    :return: The output lines, each ending with a newline.
+    """
+    # Only the columns up to the first sample's are changed; the rest
+    # stay in one piece.
+    elems = line.split("\t", SAMPLE_DATA_INDEX + 1)
+    alleleDepthIndex = ad_indexes[elems[FORMAT_CELL_INDEX]]
+    sample = elems[SAMPLE_DATA_INDEX].split(":")
+    ads = list(map(int, sample[alleleDepthIndex].split(',')))
     totalAlleleDepth = sum(ads)
     # update filter cell with minDP to fail if the totalAlleleDepth
     # is less than the specified value
@@ -93,37 +137,275 @@ for line in inp:
             elems[FILTER_CELL_INDEX] = "minDP"
         else:
             elems[FILTER_CELL_INDEX] += ";minDP"
+
+    # update the info cell to have DP_HQ or ALT_AF entries, taking
+    # care to remove any existing ones
+    info = elems[INFO_CELL_INDEX]
+    if "DP_HQ=" in info or "ALT_AF=" in info:
+        info = "".join(e + ";" for e in info.split(";")
+                       if "DP_HQ=" not in e and "ALT_AF=" not in e)
+    else:
+        info += ";"
+    info += "DP_HQ=" + str(totalAlleleDepth) + ";ALT_AF="
+
+    # add new entries for ALT_AF separately for each alternative allele.
+    # This splitting ensures that the each alternative allele and its
+    # allele frequency are on a new row, and will thus get annotated
+    # (downstream) independently.  The columns are reused from one
+    # allele to the next.
     alternativeAlleles = elems[ALT_ALLELE_INDEX].split(",")
-    alternateAlleleFrequencies = []
-    for a, ad in enumerate(ads):
+    lines = []
+    for a, alt in enumerate(alternativeAlleles, 1):
+        ad = ads[a]
         # if the Allele depths are all zero, just call it zero,
         # we can't divide by 0
         if totalAlleleDepth == 0:
-            alternateAlleleFrequencies.append("0")
+            frequency = "0"
         else:
-            alternateAlleleFrequencies.append(str(
-                round(ad * (100.0 / totalAlleleDepth))))
-    # update the info cell to have DP_HQ or ALT_AF entries, taking
-    # care to remove any existing ones
-    info_cell_items = elems[INFO_CELL_INDEX].split(";")
-    # remove any existing DP_HQ or ALT_AF entries
-    info_cell_items = [e for e in info_cell_items if "DP_HQ=" not in e]
-    info_cell_items = [e for e in info_cell_items if "ALT_AF=" not in e]
-
-    # add new entry for DP_HQ 
-    info_cell_items.append("DP_HQ=" + str(totalAlleleDepth))
-    
-    # add new entries for ALT_AF separately for each alternative allele. 
-    # This splitting ensures that the each alternative allele and its allele frequency are on a new row, and will thus get annotated (downstream) independently.
-    for a, alt in enumerate(alternativeAlleles):
-        tmp_elems = list(elems)
-        tmp_elems[ALT_ALLELE_INDEX] = alt
-        tmp_info_cell_items = list(info_cell_items)
-        tmp_info_cell_items.append("ALT_AF=" + alternateAlleleFrequencies[a+1])
-        tmp_elems[INFO_CELL_INDEX] = ";".join(tmp_info_cell_items)
-        tmp_format_cell_items = list(tmp_elems[SAMPLE_DATA_INDEX].split(":"))
-        tmp_format_cell_items[alleleDepthIndex] = "%s,%s" %(ads[0],ads[a+1])
-        tmp_elems[SAMPLE_DATA_INDEX] = ":".join(tmp_format_cell_items)
-        tmp_elems[SAMPLE_DATA_INDEX].split(":")[alleleDepthIndex] = "%s,%s" %(ads[0],ads[a+1])
-        print("\t".join(tmp_elems), file=out)
-        #print >> out, "\t".join(tmp_elems)
+            frequency = str(round(ad * (100.0 / totalAlleleDepth)))
+        elems[ALT_ALLELE_INDEX] = alt
+        elems[INFO_CELL_INDEX] = info + frequency
+        sample[alleleDepthIndex] = "%s,%s" % (ads[0], ad)
+        elems[SAMPLE_DATA_INDEX] = ":".join(sample)
+        lines.append("\t".join(elems))
+    lines.append("")
+    return "\n".join(lines)
+
+
+def process(inp, out, minimumTotalAlleleDepth):
+    """
+    Rewrite a VCF.
+
+    :param inp: The input VCF, open.
+    :param out: The output, open.
+    :param minimumTotalAlleleDepth: The minDP threshold.
+    """
+    ad_indexes = FormatCache()
+    write = out.write
+    vcf_headers = []
+    for line in inp:
+        line = line.strip()
+        if line.startswith("#"):
+            vcf_headers.append(line)
+            # adding new info headers just before the #CHROM line
+            if line.startswith("#CHROM"):
+                vcf_headers = rewrite_headers(vcf_headers,
+                                              minimumTotalAlleleDepth)
+                # write out all the headers
+                for e in vcf_headers:
+                    write(e + "\n")
+            continue
+        write(rewrite_record(line, minimumTotalAlleleDepth, ad_indexes))
+
+
+def rewrite_lines(lines, minimumTotalAlleleDepth):
+    """
+    Rewrite records, skipping any header lines among them.
+
+    :return: The output text.
+    """
+    ad_indexes = FormatCache()
+    output = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith("#"):
+            continue
+        output.append(rewrite_record(line, minimumTotalAlleleDepth,
+                                     ad_indexes))
+    return "".join(output)
+
+
+def rewrite_range(task):
+    """
+    Rewrite the records in a byte range of a plain VCF; run by a worker.
+
+    :param task: A tuple (file name, start, stop, minDP).
+    :return: The output text.
+    """
+    name, start, stop, minimumTotalAlleleDepth = task
+    with open(name, 'rb') as f:
+        f.seek(start)
+        lines = f.read(stop - start).decode().split("\n")
+    # The range ends at a line end, leaving an empty last piece.
+    if not lines[-1]:
+        lines.pop()
+    return rewrite_lines(lines, minimumTotalAlleleDepth)
+
+
+def rewrite_block(task):
+    """
+    Rewrite a block of lines of a compressed VCF; run by a worker.
+
+    :param task: A tuple (lines, minDP).
+    :return: The output text.
+    """
+    return rewrite_lines(*task)
+
+
+def range_tasks(name, out, minimumTotalAlleleDepth):
+    """
+    Write the header of a plain VCF, and split the rest into byte
+    ranges ending at line ends.
+
+    :return: A generator of (function, task) for the workers.
+    """
+    headers = []
+    with open(name, 'rb') as f:
+        start = 0
+        for line in f:
+            if not line.startswith(b"#"):
+                break
+            headers.append(line.decode())
+            start += len(line)
+        end = os.fstat(f.fileno()).st_size
+        process(headers, out, minimumTotalAlleleDepth)
+        while start < end:
+            f.seek(min(start + RANGE_SIZE, end))
+            f.readline()
+            stop = min(f.tell(), end)
+            yield rewrite_range, (name, start, stop, minimumTotalAlleleDepth)
+            start = stop
+
+
+def block_tasks(name, out, minimumTotalAlleleDepth):
+    """
+    Write the header of a VCF, and read the rest in blocks of lines.
+
+    :return: A generator of (function, task) for the workers.
+    """
+    headers = []
+    block = []
+    with open_vcf(name) as inp:
+        for line in inp:
+            if line.startswith("#"):
+                headers.append(line)
+                continue
+            block.append(line)
+            break
+        process(headers, out, minimumTotalAlleleDepth)
+        for line in inp:
+            block.append(line)
+            if len(block) == BLOCK_LINES:
+                yield rewrite_block, (block, minimumTotalAlleleDepth)
+                block = []
+    if block:
+        yield rewrite_block, (block, minimumTotalAlleleDepth)
+
+
+def process_parallel(name, out, minimumTotalAlleleDepth, workers):
+    """
+    Rewrite a VCF with a pool of worker processes.  Only a few tasks
+    are queued ahead of the output, so that a compressed input is not
+    read into memory all at once.
+
+    :param name: The input VCF.
+    :param out: The output, open.
+    :param minimumTotalAlleleDepth: The minDP threshold.
+    :param workers: The number of worker processes.
+    """
+    if is_compressed(name):
+        tasks = block_tasks(name, out, minimumTotalAlleleDepth)
+    else:
+        tasks = range_tasks(name, out, minimumTotalAlleleDepth)
+    pending = collections.deque()
+    with multiprocessing.Pool(workers) as pool:
+        for function, task in tasks:
+            pending.append(pool.apply_async(function, (task,)))
+            if len(pending) > 2 * workers:
+                out.write(pending.popleft().get())
+        while pending:
+            out.write(pending.popleft().get())
+
+
+def rewrite(args, out):
+    """
+    Rewrite the input VCF into out, with --workers processes.
+    """
+    if args.workers > 1:
+        process_parallel(args.inputFile, out, args.minDP, args.workers)
+        return
+    with open_vcf(args.inputFile) as inp:
+        process(inp, out, args.minDP)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Recompute the depth from the allele depths, filter '
+                    'on a minimum depth, and add ALT_AF.')
+    parser.add_argument('-z', '--bgzip', action='store_true',
+                        help='Compress the output with bgzip (the default '
+                             'if its name ends in .gz)')
+    parser.add_argument('-x', '--index', action='store_true',
+                        help='Index the output with tabix (implies '
+                             '--bgzip)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Worker processes rewriting the records [1]')
+    parser.add_argument('inputFile',
+                        help='The VCF, plain or gzip/BGZF compressed')
+    parser.add_argument('outputFile')
+    parser.add_argument('minDP', type=int)
+    args = parser.parse_args()
+    if args.index or args.outputFile.endswith('.gz'):
+        args.bgzip = True
+    return args
+
+
+def is_compressed(name):
+    """
+    :return: Whether the file is gzip compressed (including BGZF).
+    """
+    with open(name, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def open_vcf(name):
+    """
+    Open a plain or gzip compressed (including BGZF) VCF for reading.
+    """
+    if is_compressed(name):
+        return gzip.open(name, 'rt')
+    return open(name, 'r')
+
+
+def run_bgzip(args):
+    """
+    Process the VCF through bgzip into the output file.
+
+    :return: The exit status of bgzip.
+    """
+    with open(args.outputFile, 'wb') as f:
+        bgzip = subprocess.Popen(['bgzip', '-c'], stdin=subprocess.PIPE,
+                                 stdout=f, universal_newlines=True,
+                                 bufsize=BUFFER_SIZE)
+        try:
+            rewrite(args, bgzip.stdin)
+        finally:
+            bgzip.stdin.close()
+            status = bgzip.wait()
+    return status
+
+
+def main():
+    args = parse_args()
+
+    if not args.bgzip:
+        with open(args.outputFile, 'w', buffering=BUFFER_SIZE) as out:
+            rewrite(args, out)
+        return
+
+    status = run_bgzip(args)
+    if status:
+        print("bgzip failed, exit status {0}".format(status),
+              file=sys.stderr)
+        sys.exit(1)
+    if args.index:
+        status = subprocess.call(['tabix', '-f', '-p', 'vcf',
+                                  args.outputFile])
+        if status:
+            print("tabix failed, exit status {0}".format(status),
+                  file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
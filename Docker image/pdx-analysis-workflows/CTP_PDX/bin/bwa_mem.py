@@ -4,52 +4,320 @@ from __future__ import print_function
 """
 BWA-Mem Alignment to reference genome.
 Version: 1.0.0
+
+By default bwa mem is piped straight into samtools, which writes the
+BAM, coordinate sorted with --sort, without an intermediate out.sam.
+--sam writes out.sam first and converts it afterwards, as before.
+The exit status is that of the first step of the pipeline that failed.
+--shards N aligns N chunks of the reads at the same time and merges
+the BAMs.  Threads and sort memory default to the cores and memory
+Galaxy allocated to the job; see job_resources.py.
 """
 import sys
 import os
+import argparse
+import gzip
+import itertools
+import random
+import shutil
+import subprocess
+import tempfile
+
+import job_resources
+
+
+def openFastq(path, mode='rt'):
+    """Open a FASTQ file for reading, gzip compressed or not."""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+def readLengths(path):
+    """Yield the length of the sequence line of each read, one at a time."""
+    with openFastq(path) as fastq:
+        for n, line in enumerate(fastq):
+            if n % 4 == 1:
+                yield len(line.strip('\n'))
+
+def reservoirSample(items, size, seed=0):
+    """Uniform random sample of size items, in a single pass."""
+    rng = random.Random(seed)
+    sample = []
+    for n, item in enumerate(items):
+        if n < size:
+            sample.append(item)
+        else:
+            k = rng.randint(0, n)
+            if k < size:
+                sample[k] = item
+    return sample
 
+def averageReadLength(path, sample=0, reservoir=False):
+    """
+    Mean read length of a FASTQ file, in constant memory.
+    sample: use only this many reads; 0 reads the whole file.
+    reservoir: sample the reads at random from the whole file instead
+    of taking the first ones.
+    """
+    lengths = readLengths(path)
+    if sample and reservoir:
+        lengths = reservoirSample(lengths, sample)
+    elif sample:
+        lengths = itertools.islice(lengths, sample)
+    total = 0
+    count = 0
+    for length in lengths:
+        total += length
+        count += 1
+    if not count:
+        raise ValueError('No reads in %s' % path)
+    return total / count
 
-def averageLineLength(forward, reverse):
-    fn1 = open(forward)
-    fn2 = open(reverse)
-    lines1 = fn1.readlines()
-    lines2 = fn2.readlines()
-    avg_forward = sum([len(line.strip('\n')) for line in lines1[1::4]]) / (len(lines1)/4)
-    avg_reverse = sum([len(line.strip('\n')) for line in lines2[1::4]]) / (len(lines2)/4)
+def averageLineLength(forward, reverse, sample=0, reservoir=False):
+    avg_forward = averageReadLength(forward, sample, reservoir)
+    avg_reverse = averageReadLength(reverse, sample, reservoir)
     return (avg_forward + avg_reverse)/2
 
+def parseArgs():
+    parser = argparse.ArgumentParser(
+        description='BWA-Mem alignment to reference genome.')
+    parser.add_argument('bwa_index')
+    parser.add_argument('forward_reads')
+    parser.add_argument('reverse_reads', help='"none" for single end reads')
+    parser.add_argument('types', help='"paired" or "single"')
+    parser.add_argument('-t', '--threads', type=int,
+                        help='bwa mem threads [the cores of the job]')
+    parser.add_argument('--sam', action='store_true',
+                        help='Write out.sam and convert it afterwards, '
+                             'instead of piping bwa into samtools')
+    parser.add_argument('--sort', action='store_true',
+                        help='Coordinate sort the BAM in the same pipeline')
+    parser.add_argument('--sort-memory',
+                        help='samtools sort memory per thread [a quarter '
+                             'of the memory of the job, shared among the '
+                             'samtools threads, 256M to 2G]')
+    parser.add_argument('--samtools-threads', type=int,
+                        help='samtools sort or compression threads [half '
+                             'the cores of the job]')
+    parser.add_argument('-r', '--read-group', default='read_group',
+                        help='The file holding the read group line, as '
+                             'written by read_group_from_fastq.py; for '
+                             'another lane, its own file [read_group]')
+    parser.add_argument('-o', '--output', default='aln.bam',
+                        help='The BAM file [aln.bam]')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Split the reads into this many chunks, align '
+                             'them with as many bwa mem processes at the '
+                             'same time, sharing the threads, and merge '
+                             'the BAMs [1]')
+    return parser.parse_args()
+
+def bwaCommand(read_group, threads, bwa_index, fastqs):
+    return ['bwa', 'mem', '-t' + str(threads), '-R', read_group,
+            bwa_index] + list(fastqs)
+
+def bamCommand(args, sam, output, threads):
+    """The samtools command converting (or sorting) sam into a BAM."""
+    if args.sort:
+        return ['samtools', 'sort', '-@', str(threads),
+                '-m', args.sort_memory, '-T', output + '.tmp',
+                '-O', 'bam', sam]
+    return ['samtools', 'view', '-@', str(threads),
+            '-1', '-S', '-b', sam]
+
+def exitStatus(command, status):
+    """0, or a failed command's exit status reported the way the shell does."""
+    if status != 0:
+        print('%s exited with status %d' % (command[0], status),
+              file=sys.stderr)
+        if status < 0:
+            # Killed by a signal.
+            return 128 - status
+    return status
+
+def startPipeline(commands, output):
+    """
+    Start the commands connected by pipes, the last one writing to output.
+    Returns their processes.
+    """
+    print(' | '.join(' '.join(command) for command in commands) +
+          ' > ' + output)
+    sys.stdout.flush()
+    procs = []
+    with open(output, 'wb') as out:
+        stdin = None
+        for n, command in enumerate(commands):
+            stdout = out if n == len(commands) - 1 else subprocess.PIPE
+            try:
+                proc = subprocess.Popen(command, stdin=stdin, stdout=stdout)
+            except OSError:
+                killPipeline(procs)
+                raise
+            if stdin is not None:
+                # Only the reader holds the pipe now, so the writer gets
+                # SIGPIPE if the reader dies.
+                stdin.close()
+            stdin = proc.stdout
+            procs.append(proc)
+    return procs
+
+def killPipeline(procs):
+    for proc in procs:
+        proc.kill()
+        proc.wait()
+
+def waitPipeline(commands, procs):
+    """
+    Returns 0, or the exit status of the last command that failed, as
+    with set -o pipefail: a writer killed by SIGPIPE when its reader
+    failed must not hide the reader's error.
+    """
+    result = 0
+    for command, proc in zip(commands, procs):
+        status = exitStatus(command, proc.wait())
+        if status != 0:
+            result = status
+    return result
+
+def runPipeline(commands, output):
+    return waitPipeline(commands, startPipeline(commands, output))
+
+def countReads(path):
+    """The number of reads in a FASTQ file, counting newlines in blocks."""
+    lines = 0
+    with openFastq(path, 'rb') as fastq:
+        for block in iter(lambda: fastq.read(1 << 20), b''):
+            lines += block.count(b'\n')
+    return lines // 4
+
+def splitFastq(path, reads, directory, name):
+    """
+    Split a FASTQ file into chunks of reads reads, in order, in directory.
+    Returns the names of the chunks.
+    """
+    chunks = []
+    with openFastq(path, 'rb') as fastq:
+        while True:
+            lines = itertools.islice(fastq, 4 * reads)
+            first = next(lines, None)
+            if first is None:
+                break
+            chunk = os.path.join(directory,
+                                 '%s_%d.fastq' % (name, len(chunks)))
+            with open(chunk, 'wb') as out:
+                out.write(first)
+                out.writelines(lines)
+            chunks.append(chunk)
+    return chunks
+
+def alignShards(args, read_group, fastqs):
+    """
+    Split the reads into args.shards chunks at read boundaries, the
+    forward and reverse files alike, align the chunks at the same time,
+    each pipeline with its share of the threads, and merge the BAMs:
+    samtools merge for sorted BAMs, samtools cat, which keeps the read
+    order, otherwise.
+    """
+    directory = tempfile.mkdtemp(prefix='bwa_shards.', dir='.')
+    try:
+        reads = countReads(fastqs[0])
+        per_shard = max(1, -(-reads // args.shards))
+        print('Splitting %d reads into chunks of %d' % (reads, per_shard))
+        chunks = [splitFastq(path, per_shard, directory, 'R%d' % (n + 1))
+                  for n, path in enumerate(fastqs)]
+        if len(set(len(end) for end in chunks)) != 1:
+            print('The forward and reverse reads differ in number',
+                  file=sys.stderr)
+            return 1
+        shards = list(zip(*chunks))
+        threads = max(1, args.threads // len(shards))
+        samtools_threads = max(1, args.samtools_threads // len(shards))
+        pipelines = []
+        bams = []
+        try:
+            for n, shard in enumerate(shards):
+                bam = os.path.join(directory, 'shard_%d.bam' % n)
+                commands = [bwaCommand(read_group, threads, args.bwa_index,
+                                       shard),
+                            bamCommand(args, '-', bam, samtools_threads)]
+                pipelines.append((commands, startPipeline(commands, bam)))
+                bams.append(bam)
+        except OSError:
+            for commands, procs in pipelines:
+                killPipeline(procs)
+            raise
+        for commands, procs in pipelines:
+            status = waitPipeline(commands, procs)
+            if status != 0:
+                for commands, procs in pipelines:
+                    killPipeline(procs)
+                return status
+        if args.sort:
+            merge = ['samtools', 'merge', '-@', str(args.samtools_threads),
+                     '-c', '-p', '-f', args.output] + bams
+        else:
+            merge = ['samtools', 'cat', '-o', args.output] + bams
+        print(' '.join(merge))
+        sys.stdout.flush()
+        return exitStatus(merge, subprocess.call(merge))
+    finally:
+        shutil.rmtree(directory)
+
+def allocate(args):
+    """
+    Size the threads and sort memory not given on the command line to
+    the cores and memory of the job.  bwa mem holds the index in memory
+    while samtools sorts, so the sort gets a quarter of the memory.
+    """
+    cores, source = job_resources.cpus()
+    if args.threads is None:
+        args.threads = cores
+    if args.samtools_threads is None:
+        args.samtools_threads = max(1, cores // 2)
+    if args.sort_memory is None:
+        args.sort_memory = job_resources.memory_per_thread(
+            args.samtools_threads, 0.25)
+    print('Cores: %d (%s); bwa threads: %d; samtools threads: %d; '
+          'sort memory per thread: %s' % (cores, source, args.threads,
+                                          args.samtools_threads,
+                                          args.sort_memory))
+
 def main():
-    bwa_index = sys.argv[1]
-    forward_reads = sys.argv[2]
-    reverse_reads = sys.argv[3]
-    types = sys.argv[4]
+    args = parseArgs()
+    allocate(args)
     try:
-        file = open("read_group", "r")
-        read_group = "'" + str(file.read()).strip() + "'"
+        file = open(args.read_group, "r")
+        read_group = str(file.read()).strip()
         print(read_group)
         file.close()
     except Exception as e:
         print('Error while executing opening file %s' % e)
         sys.exit(1)
-    try:
-        #command = "seqtk mergepe " + forward_reads + " " + reverse_reads + " > out.fq"
-        #print(command)
-        #os.system(command)
-        if types == "paired" :
-            command = "bwa mem -t8 -R " + read_group + " " + bwa_index + " " + forward_reads + " " + reverse_reads + " > out.sam"
-            print(command)
-            os.system(command)
-        else :
-            command = "bwa mem -t8 -R " + read_group + " " + bwa_index + " " + forward_reads + " > out.sam"
-            print(command)
-            os.system(command)
-        command = "samtools view -1 -S -b out.sam > aln.bam"
-        print(command)
-        os.system(command)
-    except Exception as e:
-        print('Error while executing bwamem -> %s %s' % command % e)
+    if '\n' in read_group:
+        print('%s holds more than one read group; bwa takes one'
+              % args.read_group, file=sys.stderr)
         sys.exit(1)
+    #command = "seqtk mergepe " + forward_reads + " " + reverse_reads + " > out.fq"
+    fastqs = [args.forward_reads]
+    if args.types == "paired":
+        fastqs.append(args.reverse_reads)
+    bwa = bwaCommand(read_group, args.threads, args.bwa_index, fastqs)
+    bam = bamCommand(args, '-', args.output, args.samtools_threads)
+    try:
+        if args.shards > 1:
+            status = alignShards(args, read_group, fastqs)
+        elif args.sam:
+            status = runPipeline([bwa], 'out.sam')
+            if status == 0:
+                status = runPipeline(
+                    [bamCommand(args, 'out.sam', args.output,
+                                args.samtools_threads)], args.output)
+        else:
+            status = runPipeline([bwa, bam], args.output)
+    except OSError as e:
+        print('Error while executing bwamem -> %s' % e, file=sys.stderr)
+        return 1
+    return status
 
 if __name__ == '__main__':
-    main()
-    sys.exit(0)
+    sys.exit(main())
@@ -13,12 +13,26 @@ This will be fixed in the pipeline, but we don't want to have to rerun
 the pipelines just to clean this up. So this program will go over the existing
 *Annotated.tab files, and remove the gene names from any variant whose effect
 is "intragenic_region".
+
+Each file is read once: the rows are written to a temporary file next to
+it as they are read, and the temporary file replaces the original only if
+some gene name was removed.  With --root, the files are processed by a
+pool of worker processes.
 """
 import csv
+import multiprocessing
 import os
+import shutil
+import sys
+import tempfile
 from glob import glob
 import argparse
 
+import job_resources
+
+EFFECT_COLUMN = 'EFF[*].EFFECT'
+GENE_COLUMN = 'EFF[*].GENE'
+
 
 def parse_args():
     """
@@ -37,6 +51,9 @@ def parse_args():
                              "[Default = .ORIG]")
     parser.add_argument('-d', '--delete', action='store_true',
                         help="Delete the original file.")
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help="Worker processes for --root "
+                             "[Default = the cores of the job]")
     args = parser.parse_args()
 
     if args.root and args.file_name:
@@ -57,84 +74,112 @@ def get_files(root):
     return files
 
 
-def get_header(fn):
-    """
-    Get the header columns as a list.
-    :param fn: A filename from which we will use the first row to determine
-        the column names.
-    :return: a list of column names.
-    """
-    with open(fn) as f:
-        line = f.readline()
-        headers = line.strip().split('\t')
-    return headers
-
-
-def needs_processing(fn):
+def clean_rows(reader, writer, effect, gene, width):
     """
-    Check a file to see if it has the condition that we have to clean up,
-    before we go to the effort to re-write the whole file.
-    :param fn: The filename to check.
-    :return: True if we need to process the file.
+    Copy the rows, clearing the gene name of intergenic_region variants.
+    :param reader: A csv reader, past the header.
+    :param writer: A csv writer.
+    :param effect: The index of the effect column.
+    :param gene: The index of the gene name column.
+    :param width: The number of columns; short rows are filled out.
+        Blank lines are dropped.
+    :return: True if any gene name was cleared.
     """
-    f = open(fn)
-    reader = csv.DictReader(f, delimiter='\t')
-    ret = False
+    changed = False
     for row in reader:
-        if row['EFF[*].EFFECT'] == 'intergenic_region' and \
-                row['EFF[*].GENE'] != '':
-            ret = True
-            break
-    f.close()
-    return ret
+        if not row:
+            continue
+        if len(row) < width:
+            row += [''] * (width - len(row))
+        if row[effect] == 'intergenic_region' and row[gene] != '':
+            row[gene] = ''
+            changed = True
+        writer.writerow(row)
+    return changed
 
 
 def process_file(fn, args):
     """
-    Process one file.  Make sure the headers are the same as the initial file;
+    Process one file.  The columns are found from the header of each file;
     there is a possibility that different pipelines have different file formats.
 
-    We will rename the original file with the extension .ORIG, and write a new
-    file with the original name.
+    If any gene name is cleared, we will rename the original file with the
+    extension .ORIG (or delete it, with --delete), and put the new file in its
+    place.
 
     :param fn: The path to the file to process.
     :param args: The parsed command line arguments
-    :return:
+    :return: True if the file was changed.
     """
-    if not needs_processing(fn):
-        # Nothing to do.
-        return
-    headers = get_header(fn)
-    orig_file = fn + args.suffix
-    os.rename(fn, orig_file)
-    in_f = open(orig_file)
-    out_f = open(fn, 'w')
-
-    reader = csv.DictReader(in_f, delimiter='\t')
-    writer = csv.DictWriter(out_f, headers, delimiter='\t', lineterminator='\n')
-    writer.writeheader()
-    for row in reader:
-        if row['EFF[*].EFFECT'] == 'intergenic_region':
-            # print(row)
-            row['EFF[*].GENE'] = ''
-            # print(row)
-        writer.writerow(row)
-    in_f.close()
-    out_f.close()
-    if args.delete:
-        os.remove(orig_file)
+    directory, name = os.path.split(fn)
+    fd, tmp_file = tempfile.mkstemp(prefix='.' + name, suffix='.tmp',
+                                    dir=directory or '.')
+    try:
+        with open(fn) as in_f, os.fdopen(fd, 'w') as out_f:
+            line = in_f.readline()
+            columns = next(csv.reader([line], delimiter='\t'), [])
+            reader = csv.reader(in_f, delimiter='\t')
+            writer = csv.writer(out_f, delimiter='\t', lineterminator='\n')
+            writer.writerow(line.strip().split('\t'))
+            try:
+                effect = columns.index(EFFECT_COLUMN)
+                gene = columns.index(GENE_COLUMN)
+            except ValueError:
+                # Not an annotated variants file; nothing to clean.
+                changed = False
+            else:
+                changed = clean_rows(reader, writer, effect, gene,
+                                     len(columns))
+        if not changed:
+            os.remove(tmp_file)
+            return False
+        shutil.copymode(fn, tmp_file)
+        if not args.delete:
+            os.rename(fn, fn + args.suffix)
+        os.rename(tmp_file, fn)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return True
+
+
+def process_task(task):
+    """
+    Process one file in a worker.
+    :param task: A tuple (the path to the file, the parsed arguments).
+    :return: A tuple (the path, whether it was changed, an error or None).
+    """
+    fn, args = task
+    try:
+        return fn, process_file(fn, args), None
+    except (IOError, OSError, csv.Error) as e:
+        return fn, False, str(e)
 
 
 def main():
     args = parse_args()
     if args.root:
         files = get_files(args.root)
-        for fn in files:
-            if not needs_processing(fn):
-                # print('***Skipping', fn)
-                continue
-            print('PROCESSING', fn)
-            process_file(fn, args)
+        if not files:
+            return
+        jobs = min(job_resources.threads(args.jobs)[0], len(files))
+        pool = multiprocessing.Pool(jobs)
+        failed = False
+        try:
+            for fn, changed, error in pool.imap_unordered(
+                    process_task, [(fn, args) for fn in files],
+                    max(1, len(files) // (jobs * 16))):
+                if error is not None:
+                    print('FAILED', fn, error, file=sys.stderr)
+                    failed = True
+                elif changed:
+                    print('PROCESSED', fn)
+        finally:
+            pool.close()
+            pool.join()
+        if failed:
+            sys.exit(1)
     else:
         # The argument parser guarantees that we'll have either root or
         # file_name.
@@ -1,6 +1,29 @@
 #!/usr/bin/env python
 
+"""
+Per-target coverage from GATK per-base coverage rows (chr, start, stop,
+gene, position, coverage), grouped by target.
+
+    coveragecalculator.py targetbed targetcov
+
+writes the mean, median, min and max coverage of each target.
+
+    coveragecalculator.py --matrix matrix.tsv [--thresholds 10,20]
+                          [--names a,b] sample_a.bed sample_b.bed ...
+
+merges the rows of several samples target by target and writes one
+row per target with the mean and median coverage of each sample, and
+the fraction of its bases covered at least N times for each threshold.
+Each file is read as a stream, one target at a time, and the files are
+merged on (chr, start, stop, gene).  They must be sorted by chromosome
+in natural order (chr2 before chr10; as sort -k1,1V does) and then by
+start and stop; a target missing from some of them is NA there.
+"""
+import argparse
 import csv
+import heapq
+import os
+import re
 import sys
 import numpy as np
 from collections import defaultdict
@@ -13,35 +36,207 @@ if len(sys.argv) < 2:
     sys.exit()
 
 
-targetbed = open(sys.argv[1],"r")
-targetcov = open(sys.argv[2],"w")
+class TargetCoverage(object):
+    """
+    The coverage of one target, aggregated as its per-base rows stream
+    past: a running sum, min and max, and a histogram of the coverage
+    values for the exact median.  The memory used depends on the number
+    of distinct coverage values, not on the number of bases.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.histogram = defaultdict(int)
 
-chr_a=[]
-start_a=[]
-stop_a=[]
-bp_a=[]
-cov_a=[]
-gene_a=[]
+    def add(self, coverage):
+        self.count += 1
+        self.total += coverage
+        if self.min is None or coverage < self.min:
+            self.min = coverage
+        if self.max is None or coverage > self.max:
+            self.max = coverage
+        self.histogram[coverage] += 1
 
-with targetbed as f:
-     reader=csv.reader(f,delimiter='\t')
-     for a,b,c,d,e,f in reader:
-         chr_a.append(a)
-         start_a.append(b)
-         stop_a.append(c)
-         gene_a.append(d)
-         cov_a.append(f)
+    def mean(self):
+        return self.total / float(self.count)
 
-target_keys = zip(chr_a,start_a,stop_a,gene_a)
+    def median(self):
+        """
+        The same value as numpy.median() of all the coverage values: the
+        middle one, or the mean of the two middle ones.
+        """
+        lower = None
+        seen = 0
+        for coverage in sorted(self.histogram):
+            seen += self.histogram[coverage]
+            if lower is None and seen > (self.count - 1) // 2:
+                lower = coverage
+            if seen > self.count // 2:
+                return np.float64((lower + coverage) / 2.0)
 
-result_dict = defaultdict(list)
+    def fraction_at_least(self, depth):
+        """
+        The fraction of the bases covered at least depth times.
+        """
+        covered = sum(count for coverage, count in
+                      self.histogram.iteritems() if coverage >= depth)
+        return covered / float(self.count)
+
+    # End of class TargetCoverage.
+
+
+def targets(rows):
+    """
+    Group consecutive per-base rows (chr, start, stop, gene, position,
+    coverage) by target.
+
+    :param rows: The rows of the coverage BED.
+    :return: A generator of the TargetCoverage of each target.
+    """
+    target = None
+    for a,b,c,d,e,f in rows:
+        key = (a,b,c,d)
+        if target is None or key != target.key:
+            if target is not None:
+                yield target
+            target = TargetCoverage(key)
+        if f:
+            target.add(int(f))
+    if target is not None:
+        yield target
+
+
+def chromosome_key(chrom):
+    """
+    Natural order of chromosome names: the digits in them compare as
+    numbers, so chr2 comes before chr10.
+    """
+    return tuple((0, int(part)) if part.isdigit() else (1, part)
+                 for part in re.split(r'(\d+)', chrom))
+
+
+def merge_key(target):
+    """
+    :return: The merge key of a TargetCoverage.
+    """
+    chrom, start, stop, gene = target.key
+    return chromosome_key(chrom), int(start), int(stop), gene
 
-print >>targetcov,'chr',"\t", 'start',"\t", 'stop',"\t",'Gene name',"\t",'Mean_coverage',"\t",'Median_coverage',"\t",'min_coverage',"\t",'Max_coverage'
 
-for k,v in zip(target_keys,cov_a):
-    result_dict[k].append(v)
+def merge_samples(streams):
+    """
+    k-way merge of the targets of several samples.
 
+    :param streams: A target generator for each sample.
+    :return: A generator of lists with the TargetCoverage of each
+    sample for one target, None for the samples without it.
+    """
+    heap = []
+    last = [None] * len(streams)
 
-for k,v in result_dict.iteritems():
-    L = [int(n) for n in v if n]
-    print >>targetcov,k[0],"\t",k[1],"\t",k[2],"\t",k[3],"\t",sum(L)/float(len(L)),"\t",np.median(L),"\t",min(L),"\t",max(L)
\ No newline at end of file
+    def push(n):
+        for target in streams[n]:
+            key = merge_key(target)
+            if last[n] is not None and key <= last[n]:
+                print >>sys.stderr, 'Sample {0} is not sorted by target ' \
+                    'at {1}; sort it with sort -k1,1V -k2,2n -k3,3n' \
+                    .format(n + 1, ' '.join(target.key))
+                sys.exit(1)
+            last[n] = key
+            heapq.heappush(heap, (key, n, target))
+            return
+
+    for n in range(len(streams)):
+        push(n)
+    while heap:
+        key = heap[0][0]
+        row = [None] * len(streams)
+        while heap and heap[0][0] == key:
+            n, target = heapq.heappop(heap)[1:]
+            row[n] = target
+            push(n)
+        yield row
+
+
+def write_matrix(out, names, rows, thresholds):
+    columns = ['chr', 'start', 'stop', 'Gene name']
+    for name in names:
+        columns += [name + '_Mean_coverage', name + '_Median_coverage']
+        columns += ['{0}_fraction_ge_{1}x'.format(name, depth)
+                    for depth in thresholds]
+    print >>out, '\t'.join(columns)
+    for row in rows:
+        key = next(t.key for t in row if t is not None)
+        fields = list(key)
+        for t in row:
+            if t is None or not t.count:
+                fields += ['NA'] * (2 + len(thresholds))
+                continue
+            fields += ['{0:.2f}'.format(t.mean()), str(t.median())]
+            fields += ['{0:.4f}'.format(t.fraction_at_least(depth))
+                       for depth in thresholds]
+        print >>out, '\t'.join(fields)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Per-target coverage from per-base coverage rows')
+    parser.add_argument('-m', '--matrix', metavar='MATRIX',
+                        help='Write the coverage of all the samples given '
+                             'to this one matrix')
+    parser.add_argument('-t', '--thresholds', default='2,10,20,30,40,50,100',
+                        help='Coverage thresholds for the matrix, '
+                             'comma separated [2,10,20,30,40,50,100]')
+    parser.add_argument('-n', '--names',
+                        help='Sample names for the matrix, comma separated '
+                             '[the file names]')
+    parser.add_argument('files', nargs='+',
+                        help='targetbed targetcov; with --matrix, the '
+                             'targetbed of each sample')
+    args = parser.parse_args()
+    if args.matrix is None and len(args.files) != 2:
+        parser.error('Give the targetbed and the targetcov file.')
+    args.thresholds = [int(depth) for depth in args.thresholds.split(',')]
+    if args.names:
+        args.names = args.names.split(',')
+        if len(args.names) != len(args.files):
+            parser.error('Give one name per file.')
+    else:
+        args.names = [os.path.basename(name).split('.')[0]
+                      for name in args.files]
+    return args
+
+
+args = parse_args()
+
+if args.matrix is not None:
+    beds = [open(name, "r") for name in args.files]
+    streams = [targets(csv.reader(f, delimiter='\t')) for f in beds]
+    # Written to a temporary file that replaces the matrix at the end, so
+    # that an unsorted sample found half way leaves no partial matrix.
+    tmp = '{0}.{1}.tmp'.format(args.matrix, os.getpid())
+    try:
+        with open(tmp, "w") as out:
+            write_matrix(out, args.names, merge_samples(streams),
+                         args.thresholds)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    os.rename(tmp, args.matrix)
+    for f in beds:
+        f.close()
+    sys.exit()
+
+targetbed = open(args.files[0],"r")
+targetcov = open(args.files[1],"w")
+
+print >>targetcov,'chr',"\t", 'start',"\t", 'stop',"\t",'Gene name',"\t",'Mean_coverage',"\t",'Median_coverage',"\t",'min_coverage',"\t",'Max_coverage'
+
+with targetbed as f:
+    reader=csv.reader(f,delimiter='\t')
+    for t in targets(reader):
+        k = t.key
+        print >>targetcov,k[0],"\t",k[1],"\t",k[2],"\t",k[3],"\t",t.mean(),"\t",t.median(),"\t",t.min,"\t",t.max
@@ -12,10 +12,27 @@ followed by two rows; a header and data.
 
 we'll read both lines and then pick out the field matching the requested coverage level.
 
+The file is parsed by picard_metrics, which caches the parsed metrics
+in the file given with --metrics-cache or PICARD_METRICS_CACHE.
+
+With --batch, a whole batch of files is gated at once instead: the
+files are parsed by a pool of processes, each is tested at every
+coverage level given with --levels, and a matrix of the percentages
+and PASS/FAIL of each file at each level is written to the --batch
+file, as JSON if its name ends in .json, else as TSV.
+
 """
+import json
+import multiprocessing
+import os
 import sys
 import argparse
 
+import job_resources
+import picard_metrics
+
+BATCH_LEVELS = '2,10,20,30,40,50,100'
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -35,13 +52,43 @@ def parse_args():
                         help="Minimum %% of bases covered at that depth. Enter"
                              "as a percentage or decimal (e.g., 75 or 0.75 "
                              "[default: 75]")
+    parser.add_argument('-m', '--metrics-cache',
+                        default=os.environ.get(
+                            picard_metrics.CACHE_VARIABLE),
+                        help="JSON file caching the parsed metrics of each "
+                             "file [${0}]".format(
+                                 picard_metrics.CACHE_VARIABLE))
+    parser.add_argument('-b', '--batch', metavar='MATRIX',
+                        help="Test every file at every coverage level, and "
+                             "write a pass/fail matrix to this file (JSON if "
+                             "it ends in .json, else TSV)")
+    parser.add_argument('-l', '--levels', default=BATCH_LEVELS,
+                        help="Coverage levels for --batch, comma separated "
+                             "[default: {0}]".format(BATCH_LEVELS))
+    parser.add_argument('--percentages',
+                        help="Minimum %% of bases covered for --batch, "
+                             "comma separated, one per level or one for "
+                             "all [default: --ctp-percentage]")
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help="Processes parsing the files for --batch "
+                             "[default: the cores of the job]")
     parser.add_argument('files', nargs='+',
                         help="The file[s] to test.")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    args.levels = args.levels.split(',')
+    if args.percentages:
+        args.percentages = [float(p) for p in args.percentages.split(',')]
+    else:
+        args.percentages = [args.ctp_percentage]
+    if len(args.percentages) == 1:
+        args.percentages *= len(args.levels)
+    if len(args.percentages) != len(args.levels):
+        parser.error("Give one percentage per level, or one for all.")
+    return args
 
 
-def process_file(fn, coverage, percentage, multiple, debug):
+def process_file(fn, coverage, percentage, multiple, debug, cache=None):
     """
     Determine whether there was adequate coverage of bases in this file.
     NOTE: Returns True if the run was OK.
@@ -50,37 +97,27 @@ def process_file(fn, coverage, percentage, multiple, debug):
     :param percentage:
     :param multiple:
     :param debug:
+    :param cache: A picard_metrics.MetricsCache, or None.
     :return:
     """
-    metadata_ended = False
     pattern = 'PCT_TARGET_BASES_{0}X'.format(coverage)
-    header = []
-    data = []
-    for line in open(fn):
-        line = line.strip()
-        if not metadata_ended:
-            if line.startswith('## METRICS CLASS'):
-                metadata_ended = True
-            continue
-        if not header:
-            # process the header line
-            header = line.split()
-        else:
-            # process the data line
-            data = line.split()
-            break
-
     try:
-        idx = header.index(pattern)
-    except ValueError:
+        metrics = picard_metrics.read_metrics(fn, cache)
+    except picard_metrics.MetricsError as e:
+        print("Could not find coverage column {0} in: {1}\n"
+              "{2}".format(pattern, fn, e), file=sys.stderr)
+        return False
+
+    if pattern not in metrics:
         print("Could not find coverage column {0} in: {1}\n"
-              "header line is\n{2}".format(pattern, fn, header),
+              "header line is\n{2}".format(pattern, fn, metrics.header),
               file=sys.stderr)
         return False
 
     if debug:
-        print("Percentage at {0} is {1}".format(header[idx], data[idx]))
-    this_percentage = float(data[idx])
+        print("Percentage at {0} is {1}".format(pattern,
+                                                metrics.raw(pattern)))
+    this_percentage = float(metrics.raw(pattern))
     if this_percentage < percentage:
         if multiple:
             print("{0}X\t{1}\t{2}".format(coverage, this_percentage, fn))
@@ -93,6 +130,104 @@ def process_file(fn, coverage, percentage, multiple, debug):
     return True
 
 
+def parse_metrics(fn):
+    """
+    Parse a metrics file; run by the batch workers.
+    :return: A tuple (the metrics as JSON, None), or (None, the error).
+    """
+    try:
+        return picard_metrics.read_metrics(fn).to_json(), None
+    except (IOError, OSError, picard_metrics.MetricsError) as e:
+        return None, str(e)
+
+
+def batch_metrics(files, jobs, cache):
+    """
+    Parse the metrics files with a pool of processes, taking those in
+    the cache from it.
+    :return: A list of tuples (file, PicardMetrics or None, error).
+    """
+    results = dict((fn, (cache.get(fn), None)) for fn in files
+                   if cache is not None and os.path.exists(fn))
+    todo = [fn for fn in files if results.get(fn, (None,))[0] is None]
+    if todo:
+        jobs = min(jobs, len(todo))
+        pool = multiprocessing.Pool(jobs)
+        try:
+            chunksize = max(1, len(todo) // (jobs * 4))
+            for fn, (data, error) in zip(todo, pool.imap(parse_metrics, todo,
+                                                         chunksize)):
+                metrics = None
+                if data is not None:
+                    metrics = picard_metrics.PicardMetrics.from_json(data)
+                    if cache is not None:
+                        cache.put(fn, metrics)
+                results[fn] = (metrics, error)
+        finally:
+            pool.close()
+            pool.join()
+    return [(fn,) + results[fn] for fn in files]
+
+
+def gate_batch(args, cache):
+    """
+    Test every file at every coverage level, and write the matrix.
+    :return: True if all the files passed at all the levels.
+    """
+    percentages = [p / 100.0 if p > 1.0 else p for p in args.percentages]
+    jobs = job_resources.threads(args.jobs)[0]
+    rows = []
+    success = True
+    for fn, metrics, error in batch_metrics(args.files, jobs, cache):
+        if error is not None:
+            print("Could not read the metrics of {0}: {1}".format(fn, error),
+                  file=sys.stderr)
+        row = {'sample': os.path.basename(fn), 'file': fn, 'levels': {}}
+        passed = error is None
+        for level, percentage in zip(args.levels, percentages):
+            pattern = 'PCT_TARGET_BASES_{0}X'.format(level)
+            value = None
+            if metrics is not None and pattern in metrics:
+                value = metrics[pattern]
+                # Text that is not a number fails, like a missing column.
+                if not isinstance(value, (int, float)):
+                    value = None
+            if value is None:
+                result = 'NA'
+            elif value < percentage:
+                result = 'FAIL'
+            else:
+                result = 'PASS'
+            passed &= result == 'PASS'
+            row['levels'][level] = {'percentage': value,
+                                    'required': percentage,
+                                    'result': result}
+        row['result'] = 'PASS' if passed else 'FAIL'
+        success &= passed
+        rows.append(row)
+
+    with open(args.batch, 'w') as out:
+        if args.batch.endswith('.json'):
+            json.dump({'levels': args.levels, 'samples': rows}, out,
+                      indent=1, sort_keys=True)
+            out.write('\n')
+        else:
+            header = ['sample', 'file']
+            for level in args.levels:
+                header += ['PCT_TARGET_BASES_{0}X'.format(level),
+                           '{0}X'.format(level)]
+            print('\t'.join(header + ['result']), file=out)
+            for row in rows:
+                fields = [row['sample'], row['file']]
+                for level in args.levels:
+                    cell = row['levels'][level]
+                    value = cell['percentage']
+                    fields += ['NA' if value is None else str(value),
+                               cell['result']]
+                print('\t'.join(fields + [row['result']]), file=out)
+    return success
+
+
 def main():
     args = parse_args()
 
@@ -106,6 +241,17 @@ def main():
     if hex_percentage > 1.0:
         hex_percentage /= 100.0
 
+    cache = None
+    if args.metrics_cache:
+        cache = picard_metrics.MetricsCache(args.metrics_cache)
+
+    if args.batch:
+        if not gate_batch(args, cache):
+            print("Some files failed; see {0}".format(args.batch))
+        if cache is not None and cache.changed:
+            cache.save()
+        return
+
     success = True
     coverage = ""
     percentage = 0.0
@@ -119,7 +265,10 @@ def main():
         #else:
         #    print("Couldn't determine HEX or CTP. Assuming CTP.", file=sys.stderr)
 
-        success &= process_file(fn, coverage, percentage, multiple, debug)
+        success &= process_file(fn, coverage, percentage, multiple, debug,
+                                cache)
+    if cache is not None and cache.changed:
+        cache.save()
     if not success:
         sys.exit(0)
 
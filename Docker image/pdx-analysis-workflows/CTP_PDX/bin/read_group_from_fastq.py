@@ -1,15 +1,29 @@
 #! /usr/bin/env python
 
-""" 
+"""
  read_group_from_fastq.py
 
- Using a fastq file's name and the contents of its first line, 
+ Using a fastq file's name and the contents of its first line,
  build the option string needed for bwa to mark every read, assuming Illumina
  casava 1.8 conventions.
 
  Input: the fastq file specified as argv[1], the first command line argument.
         Handles compressed or uncompressed fastqs.
- Output: the second command line argument, if specified, else, sys.stdout.
+        The sample name, argv[2], if specified, else, from the file name.
+ Output: the third command line argument, if specified, else, sys.stdout.
+
+ Without --casava the read group is built from the sample name and the
+ file name only:  ID and SM are the sample name, LB is the file name.
+ With --casava, the ID comes from the read name of the first read:
+ instrument, run, flowcell, lane and barcode.  Each file given with
+ --lane gets a read group of its own the same way, written to a file of
+ its own: the output file name followed by .1 for the first --lane file,
+ .2 for the second and so on.  Every file holds a single line, the -R
+ argument of the bwa run aligning that lane.
+
+ Only the first read is decompressed, however large the file, and with
+ --cache the read group of each file is kept, keyed on the file's path,
+ size and modification time, so that re-runs don't open it again.
 
  Notes:
     We will usually be handling standard Illumina Casava 1.8+ output, which
@@ -19,196 +33,313 @@
 """
 
 import argparse
-import gzip
+import bz2
+import json
 import os
 import re
 import sys
 import time
+import zlib
 
 # import cga_version
-try:
-    import bz2file as bz2
-except ImportError:
-    import bz2
-
-
-# def parse_args():
-#     parser = argparse.ArgumentParser()
-#     parser.add_argument('-p', '--picard', action='store_true',
-#                         help="Use Picard format for read group line")
-#     parser.add_argument('-t', '--tumor', action='store_true',
-#                         help="Sample is tumor in a tumor/normal pair")
-#     parser.add_argument('-n', '--normal', action='store_true',
-#                         help="Sample is normal in a tumor/normal pair")
-#     parser.add_argument('fastq',
-#                         help="Path to fastq file for sample")
-#     parser.add_argument('output', nargs='?',
-#                         help="Output file name [STDOUT]")
-#
-#     args = parser.parse_args()
-#
-#     if args.tumor:
-#         if args.normal:
-#             # Check for a conflict.
-#             parser.error("Must not specify both --tumor and --normal.")
-#         args.sample_type = "Tumor_"
-#     elif args.normal:
-#         args.sample_type = "Normal_"
-#     else:
-#         args.sample_type = ""
-#
-#     return args
-#
-#
-# def multi_open(name):
-#     if name.endswith('.gz'):
-#         f = gzip.open(name)
-#     elif name.endswith('.bz2'):
-#         f = bz2.BZ2File(name)
-#     else:
-#         f = open(name)
-#     return f
-#
-#
-# def make_fake(args):
-#     """
-#     If we can't get adequate data from the file, use timestamps.
-#     :return:
-#     """
-#     # Sleep for 2 seconds, to make sure that a previous invocation
-#     # will have a different time stamp.
-#     time.sleep(2)
-#
-#     ts = time.strftime('%H%M%S')
-#
-#     id = 'ID_' + ts
-#     lb = 'LIB_' + ts
-#     sm = 'SAMPLE_' + ts
-#     bc = 'RUN_' + ts
-#     output(id, lb, sm, bc, args)
-#     sys.exit(0)
-#
-#
-# def main():
-#     # cga_version.parse_options()
-#
-#     args = parse_args()
-#
-#     # First get the info from the filename
-#     fn = os.path.split(args.fastq)[1]
-#
-#     if 'fastq' not in fn and 'fq' not in fn:
-#         print(sys.stderr, "Not seemingly a fastq file:", fn)
-#         make_fake(args)
-#         # Does not return...
-#
-#     # Now split the basename portion into its constituent parts.
-#     fn_parts = fn.split('_')
-#
-#     # Scan for the "GES" starting a filename part.  If found,
-#     # That separates the Sample name portion from the Library name.
-#     # If GES is not found starting a part, use the whole filename
-#     # as both the Sample name and the Library name.
-#     # Maybe redo this with regular expressions, but for now, it works.
-#     pos = -1
-#     for n in range(len(fn_parts)):
-#         if fn_parts[n].startswith("GES"):
-#             pos = n
-#             break
-#     if pos == -1:
-#         # Didn't find the GES marker. Use the filename up to the end name.
-#         match = re.search('(.*)[._]R[12]_.*', fn)
-#         if match is not None:
-#             fn = match.group(1)
-#         else:
-#             # something is seriously odd here, but we'll just use the
-#             # whole filename
-#             pass
-#
-#         cust_id = ges_id = fn
-#     else:
-#         cust_id = '_'.join(fn_parts[:pos])
-#         ges_parts = fn_parts[pos:]
-#         pos = 999  # Way bigger than the number of parts we'll see.
-#         for n in range(len(ges_parts)):
-#             if ges_parts[n] == 'R1' or ges_parts[n] == 'R2':
-#                 pos = n
-#                 break
-#         ges_id = '_'.join(ges_parts[:pos])
-#
-#     # Sanity check that we have some amount of text for our fields. The
-#     # down stream tools can't tolerate empty fields in the read group
-#     # information.
-#     if not ges_id:
-#         ges_id = fn
-#
-#     if not cust_id:
-#         cust_id = ges_id
-#
-#     # Now the parts from the first readname--the first line of the file.
-#     # When split on ':', the readname contains
-#     # - the ID in the first four fields.
-#     # Note: the leading '@' needs to be stripped.
-#     try:
-#         inf = multi_open(sys.argv[1])
-#         line = inf.readline()
-#     except IOError as e:
-#         print(sys.stderr, "Couldn't read the file: {0}\n    {1}". \
-#               format(fn, e.message))
-#         make_fake(args)
-#         # Does not return
-#
-#     # Example line:
-#     # @HISEQ2000:190:D19U8ACXX:5:1101:1492:1901 1:N:0:TAGCTT
-#     parts = line[1:].strip().split(' ')
-#     read_name = parts[0]
-#
-#     # Example read_name: HISEQ2000:190:D19U8ACXX:5:1101:1492:1901
-#     rparts = read_name.split(':')
-#     if len(rparts) >= 4:
-#         rparts = rparts[:4]
-#
-#     # Try to add the bar code in:
-#     bar_code = "no_barcode"
-#     if len(parts) >= 2:
-#         # Example comment: 1:N:0:TAGCTT
-#         comment = parts[1]
-#         cparts = comment.split(':')
-#         if len(cparts) == 4:
-#             bar_code = cparts[3]
-#             rparts.append(bar_code)
-#
-#     id = ':'.join(rparts)
-#     # Example id: HISEQ2000:190:D19U8ACXX:5:TAGCTT
-#
-#     output(id, ges_id, cust_id, bar_code, args)
-#
-#
-# def output(id, ges_id, cust_id, bar_code, args):
-#     if args.output is not None:
-#         of = open(args.output, 'w')
-#     else:
-#         of = sys.stdout
-#
-#     if args.picard:
-#         line = 'RGID={0}{1} RGLB={0}{2} ' \
-#                'RGPL=ILLUMINA RGSM={3} RGPU={4}'. \
-#             format(args.sample_type, id, ges_id, cust_id, bar_code)
-#     else:
-#         line = '@RG\\tID:{0}{1}\\tLB:{0}{2}\\tSM:{3}\\tPL:ILLUMINA'. \
-#             format(args.sample_type, id, ges_id, cust_id)
-#     # This needs to be a single line file; no terminating \n
-#     print(line, file=of)  # , line,
-#     # if of != sys.stdout:
-#     #    of.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--picard', action='store_true',
+                        help="Use Picard format for read group line")
+    parser.add_argument('-t', '--tumor', action='store_true',
+                        help="Sample is tumor in a tumor/normal pair")
+    parser.add_argument('-n', '--normal', action='store_true',
+                        help="Sample is normal in a tumor/normal pair")
+    parser.add_argument('-c', '--casava', action='store_true',
+                        help="Build the read group ID from the Casava 1.8 "
+                             "read name of the first read")
+    parser.add_argument('-l', '--lane', action='append', default=[],
+                        help="Another lane file of the sample; its read "
+                             "group is written to OUTPUT.1, OUTPUT.2, ... "
+                             "in the order given (implies --casava)")
+    parser.add_argument('--cache',
+                        help="JSON file caching the read group of each "
+                             "file, by path, size and modification time")
+    parser.add_argument('fastq',
+                        help="Path to fastq file for sample")
+    parser.add_argument('sample', nargs='?',
+                        help="Sample name [from the file name]")
+    parser.add_argument('output', nargs='?',
+                        help="Output file name [STDOUT]")
+
+    # Options may follow the positional arguments.
+    args = getattr(parser, 'parse_intermixed_args', parser.parse_args)()
+
+    if args.tumor:
+        if args.normal:
+            # Check for a conflict.
+            parser.error("Must not specify both --tumor and --normal.")
+        args.sample_type = "Tumor_"
+    elif args.normal:
+        args.sample_type = "Normal_"
+    else:
+        args.sample_type = ""
+
+    if args.lane:
+        if args.output is None:
+            parser.error("--lane needs an output file name.")
+        args.casava = True
+
+    return args
+
+
+def first_record(name, block_size=4096):
+    """
+    Read the first record of a fastq file, plain, gzip or bzip2
+    compressed, recognized by its first bytes rather than its name (Galaxy
+    datasets have none).  Compressed input is decompressed a small block
+    at a time, only until the record is complete.
+
+    :param name: The fastq file.
+    :param block_size: How much to read at a time.
+    :return: The lines of the first record.
+    """
+    with open(name, 'rb') as f:
+        data = f.read(block_size)
+        if data.startswith(b'\x1f\x8b'):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif data.startswith(b'BZh'):
+            decompressor = bz2.BZ2Decompressor()
+        else:
+            decompressor = None
+        record = b''
+        while data:
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            record += data
+            if record.count(b'\n') >= 4:
+                break
+            data = f.read(block_size)
+    return record.decode('ascii', 'replace').split('\n')[:4]
+
+
+def make_fake(args):
+    """
+    If we can't get adequate data from the file, use timestamps.
+    :return: The ID, library, sample and bar code.
+    """
+    # Sleep for 2 seconds, to make sure that a previous invocation
+    # will have a different time stamp.
+    time.sleep(2)
+
+    ts = time.strftime('%H%M%S')
+
+    id = 'ID_' + ts
+    lb = 'LIB_' + ts
+    sm = 'SAMPLE_' + ts
+    bc = 'RUN_' + ts
+    return id, lb, sm, bc
+
+
+def names_from_file(fastq):
+    """
+    The library and sample names from a Casava-style file name.
+    :return: A tuple (ges_id, cust_id), or None if the name doesn't look
+    like a fastq file.
+    """
+    # First get the info from the filename
+    fn = os.path.split(fastq)[1]
+
+    if 'fastq' not in fn and 'fq' not in fn:
+        print("Not seemingly a fastq file:", fn, file=sys.stderr)
+        return None
+
+    # Now split the basename portion into its constituent parts.
+    fn_parts = fn.split('_')
+
+    # Scan for the "GES" starting a filename part.  If found,
+    # That separates the Sample name portion from the Library name.
+    # If GES is not found starting a part, use the whole filename
+    # as both the Sample name and the Library name.
+    # Maybe redo this with regular expressions, but for now, it works.
+    pos = -1
+    for n in range(len(fn_parts)):
+        if fn_parts[n].startswith("GES"):
+            pos = n
+            break
+    if pos == -1:
+        # Didn't find the GES marker. Use the filename up to the end name.
+        match = re.search('(.*)[._]R[12]_.*', fn)
+        if match is not None:
+            fn = match.group(1)
+        else:
+            # something is seriously odd here, but we'll just use the
+            # whole filename
+            pass
+
+        cust_id = ges_id = fn
+    else:
+        cust_id = '_'.join(fn_parts[:pos])
+        ges_parts = fn_parts[pos:]
+        pos = 999  # Way bigger than the number of parts we'll see.
+        for n in range(len(ges_parts)):
+            if ges_parts[n] == 'R1' or ges_parts[n] == 'R2':
+                pos = n
+                break
+        ges_id = '_'.join(ges_parts[:pos])
+
+    # Sanity check that we have some amount of text for our fields. The
+    # down stream tools can't tolerate empty fields in the read group
+    # information.
+    if not ges_id:
+        ges_id = fn
+
+    if not cust_id:
+        cust_id = ges_id
+
+    return ges_id, cust_id
+
+
+def casava_id(line):
+    """
+    The read group ID and bar code from the first read name.
+    :return: A tuple (id, bar_code).
+    """
+    # Example line:
+    # @HISEQ2000:190:D19U8ACXX:5:1101:1492:1901 1:N:0:TAGCTT
+    parts = line[1:].strip().split(' ')
+    read_name = parts[0]
+
+    # Example read_name: HISEQ2000:190:D19U8ACXX:5:1101:1492:1901
+    rparts = read_name.split(':')
+    if len(rparts) >= 4:
+        rparts = rparts[:4]
+
+    # Try to add the bar code in:
+    bar_code = "no_barcode"
+    if len(parts) >= 2:
+        # Example comment: 1:N:0:TAGCTT
+        comment = parts[1]
+        cparts = comment.split(':')
+        if len(cparts) == 4:
+            bar_code = cparts[3]
+            rparts.append(bar_code)
+
+    id = ':'.join(rparts)
+    # Example id: HISEQ2000:190:D19U8ACXX:5:TAGCTT
+    return id, bar_code
+
+
+def read_group(fastq, args):
+    """
+    Build the read group line of one fastq file.
+    :return: A tuple (line, whether it may be cached).  Lines made up
+    from time stamps are not.
+    """
+    if not args.casava:
+        return format_line(args.sample, fastq, args.sample, 'no_barcode',
+                           args), True
+
+    # Now the parts from the first readname--the first line of the file.
+    # When split on ':', the readname contains
+    # - the ID in the first four fields.
+    # Note: the leading '@' needs to be stripped.
+    try:
+        line = first_record(fastq)[0]
+    except (IOError, OSError, EOFError, zlib.error) as e:
+        print("Couldn't read the file: {0}\n    {1}".format(fastq, e),
+              file=sys.stderr)
+        id, lb, sm, bar_code = make_fake(args)
+        return format_line(id, args.library, args.sample, bar_code,
+                           args), False
+
+    id, bar_code = casava_id(line)
+    return format_line(id, args.library, args.sample, bar_code, args), True
+
+
+def format_line(id, ges_id, cust_id, bar_code, args):
+    if args.picard:
+        line = 'RGID={0}{1} RGLB={0}{2} ' \
+               'RGPL=ILLUMINA RGSM={3} RGPU={4}'. \
+            format(args.sample_type, id, ges_id, cust_id, bar_code)
+    else:
+        line = '@RG\\tID:{0}{1}\\tLB:{0}{2}\\tSM:{3}\\tPL:ILLUMINA'. \
+            format(args.sample_type, id, ges_id, cust_id)
+    return line
+
+
+def cache_key(fastq, args):
+    """
+    The file's path, size and modification time, and the options the
+    line depends on.
+    """
+    st = os.stat(fastq)
+    return json.dumps([os.path.realpath(fastq), st.st_size, st.st_mtime,
+                       fastq, args.sample, args.library, args.sample_type,
+                       args.picard, args.casava])
+
+
+def load_cache(name):
+    try:
+        with open(name) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_cache(name, cache):
+    # Write a new file and rename it, so a reader never sees half of it.
+    tmp = '{0}.{1}.tmp'.format(name, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.rename(tmp, name)
+
 
 def main():
-    line = '@RG\\tID:{0}\\tLB:{1}\\tSM:{0}\\tPL:ILLUMINA'. \
-        format(sys.argv[2], sys.argv[1])
+    # cga_version.parse_options()
+
+    args = parse_args()
+    # All the lanes are of the same sample and library; name them from
+    # the first file if no sample name is given.
+    if args.sample:
+        args.library = args.sample
+    else:
+        names = names_from_file(args.fastq)
+        if names is None:
+            names = make_fake(args)[1:3]
+        args.library, args.sample = names
+
+    cache = {}
+    if args.cache:
+        cache = load_cache(args.cache)
+    changed = False
+
+    lines = []
+    for fastq in [args.fastq] + args.lane:
+        key = None
+        if args.cache:
+            try:
+                key = cache_key(fastq, args)
+            except OSError:
+                pass
+        line = cache.get(key)
+        if line is None:
+            line, cacheable = read_group(fastq, args)
+            if key is not None and cacheable:
+                cache[key] = line
+                changed = True
+        lines.append(line)
+
+    if changed:
+        save_cache(args.cache, cache)
+
+    if args.output is None:
+        print(lines[0])
+        return
 
-    # This needs to be a single line file; no terminating \n
-    of = open(sys.argv[3], 'w')
-    print(line, file=of)  # , line,
+    # bwa takes a single read group, so each file gets a file of its own.
+    outputs = [args.output] + ['{0}.{1}'.format(args.output, n)
+                               for n in range(1, len(lines))]
+    for output, line in zip(outputs, lines):
+        with open(output, 'w') as of:
+            print(line, file=of)
 
 
 if __name__ == '__main__':
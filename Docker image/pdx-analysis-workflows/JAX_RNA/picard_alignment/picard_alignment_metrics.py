@@ -11,6 +11,8 @@ import os
 import shutil
 import sys
 
+import picard_metrics
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -113,6 +115,22 @@ def main():
         print('Error executing  picard CollectRnaSeqMetrics -> %s' % e)
         sys.exit(1)
 
+    # Report the main RnaSeqMetrics; the picard commands above don't
+    # stop the run when they fail, but a missing or incomplete metrics
+    # file does.
+    cache = picard_metrics.default_cache()
+    try:
+        metrics = picard_metrics.read_metrics(picard_stat_file, cache)
+    except (IOError, OSError, picard_metrics.MetricsError) as e:
+        print('Error reading the picard CollectRnaSeqMetrics output -> %s' % e)
+        sys.exit(1)
+    if cache is not None and cache.changed:
+        cache.save()
+    for name in ('PF_BASES', 'PCT_MRNA_BASES', 'PCT_RIBOSOMAL_BASES',
+                 'PCT_INTERGENIC_BASES', 'MEDIAN_5PRIME_TO_3PRIME_BIAS'):
+        if name in metrics:
+            print('%s\t%s' % (name, metrics.raw(name)))
+
     #shutil.move(picard_stat_file, interim_results_dir)
 
     # Summary metrics compilation
@@ -0,0 +1,286 @@
+#! /usr/bin/env python
+"""
+Read Picard metrics files.
+
+A Picard metrics file consists of a metadata section, terminated by a
+line naming the metrics class, e.g.
+
+## METRICS CLASS        picard.analysis.directed.HsMetrics
+
+followed by a tab separated header row and a data row, and maybe a
+histogram after them.  Only the lines up to the data row are read.
+
+The records of the HsMetrics, DuplicationMetrics (MarkDuplicates) and
+RnaSeqMetrics classes are returned as instances of the classes below;
+any other metrics class as a PicardMetrics.  Values are looked up by
+column name, converted to int or float where they are numbers, or as
+the text Picard wrote with raw().
+
+A MetricsCache keeps the parsed records in a JSON file, one entry per
+metrics file, keyed on its path and checked against its size and
+modification time, so that reading the metrics of many runs again does
+not open their files.  A file that was rewritten replaces its entry.  It is used by
+the scripts reading metrics when the PICARD_METRICS_CACHE environment
+variable names a cache file.
+
+The same module is in CTP_PDX/bin and JAX_RNA/picard_alignment; keep
+the copies the same.
+"""
+from __future__ import print_function
+
+import json
+import os
+
+CACHE_VARIABLE = 'PICARD_METRICS_CACHE'
+
+
+class MetricsError(Exception):
+    """
+    The file has no metrics section, or it is incomplete.
+    """
+    pass
+
+
+def convert(value):
+    """
+    :return: The value as an int or a float if it is one, None if it is
+    empty or "?", else the text.
+    """
+    if value == '' or value == '?':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+class PicardMetrics(object):
+    """
+    The data row of a metrics file.
+    """
+    # The metrics class name, without its package.
+    CLASS = None
+
+    def __init__(self, metrics_class, header, values):
+        """
+        :param metrics_class: The metrics class name, without its package.
+        :param header: The column names.
+        :param values: The values of the data row, as text.
+        """
+        self.metrics_class = metrics_class
+        self.header = header
+        self.values = values
+        self.columns = dict(zip(header, values))
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return convert(self.columns[name])
+
+    def get(self, name, default=None):
+        if name not in self.columns:
+            return default
+        return self[name]
+
+    def raw(self, name):
+        """
+        :return: The value as written in the file.
+        """
+        return self.columns[name]
+
+    def to_json(self):
+        return [self.metrics_class, self.header, self.values]
+
+    @staticmethod
+    def from_json(data):
+        metrics_class, header, values = data
+        return record_type(metrics_class)(metrics_class, header, values)
+
+    # End of class PicardMetrics.
+
+
+class HsMetrics(PicardMetrics):
+    """
+    CalculateHsMetrics / CollectHsMetrics.
+    """
+    CLASS = 'HsMetrics'
+
+    def pct_target_bases(self, coverage):
+        """
+        :param coverage: 2, 10, 20, 30, 40, 50 or 100.
+        :return: The fraction of the target bases covered at least that
+        many times.
+        """
+        return self['PCT_TARGET_BASES_{0}X'.format(coverage)]
+
+    # End of class HsMetrics.
+
+
+class DuplicationMetrics(PicardMetrics):
+    """
+    MarkDuplicates; the row of the first library.
+    """
+    CLASS = 'DuplicationMetrics'
+
+    @property
+    def percent_duplication(self):
+        return self['PERCENT_DUPLICATION']
+
+    # End of class DuplicationMetrics.
+
+
+class RnaSeqMetrics(PicardMetrics):
+    """
+    CollectRnaSeqMetrics.
+    """
+    CLASS = 'RnaSeqMetrics'
+
+    @property
+    def pct_mrna_bases(self):
+        return self['PCT_MRNA_BASES']
+
+    # End of class RnaSeqMetrics.
+
+
+RECORD_TYPES = dict((cls.CLASS, cls) for cls in
+                    (HsMetrics, DuplicationMetrics, RnaSeqMetrics))
+
+
+def record_type(metrics_class):
+    return RECORD_TYPES.get(metrics_class, PicardMetrics)
+
+
+def parse(f, name='metrics file'):
+    """
+    Parse the first metrics section of an open file, reading no further
+    than its data row.
+
+    :param f: The open file.
+    :param name: The file name, for error messages.
+    :return: A PicardMetrics, of the class's own type if it has one.
+    """
+    metrics_class = None
+    header = None
+    for line in f:
+        line = line.rstrip('\r\n')
+        if metrics_class is None:
+            if line.startswith('## METRICS CLASS'):
+                # The class name, without its package.
+                metrics_class = line.split()[-1].split('.')[-1]
+            continue
+        if not line.strip():
+            continue
+        if header is None:
+            header = line.split('\t')
+            continue
+        return record_type(metrics_class)(metrics_class, header,
+                                          line.split('\t'))
+    if metrics_class is None:
+        raise MetricsError('No METRICS CLASS line in {0}'.format(name))
+    raise MetricsError('No data row for {0} in {1}'.format(metrics_class,
+                                                           name))
+
+
+class MetricsCache(object):
+    """
+    Parsed metrics kept in a compact JSON file.  Use it as a context
+    manager to save it at the end if it changed:
+
+        with MetricsCache(name) as cache:
+            metrics = read_metrics(path, cache)
+    """
+    def __init__(self, name):
+        self.name = name
+        self.changed = False
+        try:
+            with open(name) as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+        if not isinstance(self.entries, dict):
+            self.entries = {}
+        # Entries of the older format, keyed on the path, size and
+        # modification time together, are dropped.
+        for key in [key for key, entry in self.entries.items()
+                    if not isinstance(entry, dict)]:
+            del self.entries[key]
+            self.changed = True
+
+    @staticmethod
+    def stat(path):
+        """
+        :return: The file's real path, and its size and modification time.
+        """
+        st = os.stat(path)
+        return os.path.realpath(path), [st.st_size, st.st_mtime]
+
+    def get(self, path):
+        """
+        :return: The cached record, or None if there is none or the file
+        has changed since.
+        """
+        key, version = self.stat(path)
+        entry = self.entries.get(key)
+        if entry is None or entry['version'] != version:
+            return None
+        return PicardMetrics.from_json(entry['metrics'])
+
+    def put(self, path, record):
+        """
+        Cache the record of a file, replacing any older one.
+        """
+        key, version = self.stat(path)
+        self.entries[key] = {'version': version, 'metrics': record.to_json()}
+        self.changed = True
+
+    def save(self):
+        # Write a new file and rename it, so a reader never sees half of it.
+        tmp = '{0}.{1}.tmp'.format(self.name, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, separators=(',', ':'))
+        os.rename(tmp, self.name)
+        self.changed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.changed:
+            self.save()
+
+    # End of class MetricsCache.
+
+
+def default_cache():
+    """
+    :return: A MetricsCache of the file named by PICARD_METRICS_CACHE,
+    or None if it is not set.
+    """
+    name = os.environ.get(CACHE_VARIABLE)
+    if not name:
+        return None
+    return MetricsCache(name)
+
+
+def read_metrics(path, cache=None):
+    """
+    Read the metrics of a Picard metrics file.
+
+    :param path: The file.
+    :param cache: A MetricsCache, or None.
+    :return: A PicardMetrics, of the class's own type if it has one.
+    """
+    if cache is not None:
+        record = cache.get(path)
+        if record is not None:
+            return record
+    with open(path) as f:
+        record = parse(f, path)
+    if cache is not None:
+        cache.put(path, record)
+    return record
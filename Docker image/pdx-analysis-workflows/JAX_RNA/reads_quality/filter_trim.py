@@ -21,6 +21,47 @@ Script does the folllowing:
     success).
 7.  single_end: Use single end mode, even if there are multiple fastq
     files presented.
+8.  batch_size: Read this many reads per end at a time and evaluate the
+    filter and trim criteria for the whole batch with NumPy array
+    operations.  The output is identical to the per-read path, which
+    is used when batch_size is 0 (the default) or NumPy is not
+    available.
+9.  processes: Filter and trim chunks of reads in this many worker
+    processes.  The main process reads the chunks, keeping the ends
+    of a pair aligned, and writes the results back in the original
+    order, so output and statistics are identical to a single
+    process run.
+10. compress: Write the filtered, trimmed fastq files compressed,
+    either as gzip or as block gzip (BGZF), with a ".gz" extension.
+    Compression runs on background threads. The default level is 1,
+    which is fast and is the right choice for intermediate files.
+11. parallel_decompress: Decompress gzip and bzip2 input in a separate
+    process (pigz or pbzip2, if found on the PATH) or thread, instead
+    of on the thread parsing the reads.  The read rate of each input
+    file is added to the statistics file.
+12. histograms: Also collect per-cycle mean quality and N content,
+    and histograms of the quality scores and the trimmed read lengths,
+    in the same pass over the reads.  They are written to a JSON file
+    next to the statistics file.
+13. interleaved: Write the reads of both ends to one file, end 1 then
+    end 2 of each pair, instead of one file per end; "-" writes them
+    to the standard output.  A downstream aligner (e.g. bwa mem -p)
+    can then read them as they are produced.
+14. fifo: Create the output files as named pipes, so that a process
+    started alongside this one (bwa mem, Xenome) reads the reads
+    without a full size copy of them on disk.
+15. checkpoint: Every this many reads, flush the outputs and save the
+    input and output offsets and the statistics so far to a checkpoint
+    file named after the (end 1) output file, with ".checkpoint"
+    appended.  The file is removed when the run completes.
+16. resume: Carry on from the checkpoint of a run that was killed.
+    The outputs are cut back to the checkpoint, and the final output
+    and statistics are the same as an uninterrupted run's.  Without a
+    checkpoint the run starts from the beginning.
+17. phred: The quality encoding offset, 33 (Sanger, Illumina 1.8+) or
+    64 (Illumina 1.3-1.7).  With "auto", the encoding is detected from
+    the lowest quality character of the first 10,000 reads of each
+    end: 64 if none is below "@" (phred 0 in phred+64), otherwise 33.
 Trimming occurs per read; trimming does not need to match read 1 vs
 read 2 for paired end data. Filtering and acting on the
 post_trim_length_min occurs on a per-end basis; however if one read is
@@ -31,7 +72,8 @@ Inputs:
     or runs.  All pairs must be for the same sample.
 Outputs:
 1.  One or two filtered, trimmed fastq files.  The paired reads may not
-    be the same length due to trimming.
+    be the same length due to trimming.  With interleaved, one file or
+    the standard output.
 2.  Statistics file: The pipeline uses several criteria from this
     step to determine whether the run was good enough to analyze.
     a. Percent HQ reads: Number of reads written to the filtered
@@ -44,6 +86,8 @@ Outputs:
     d. Min, Max and Mean trimmed read lengths for reads whose trimmed
        length is sufficient to retain the read, reported separately for
        each end.
+3.  With histograms, the statistics file name with ".json" appended:
+    the per-cycle and histogram statistics of each end.
 All output file naming is based on the first file in each fastq file
 list the following input fastqs are not represented in the output file
 names.
@@ -59,13 +103,25 @@ non-0 = Failure:
 """
 __author__ = 'simons'
 
+import collections
+import cStringIO
 import datetime
 import gzip
 import inspect
+import json
 import math
+import multiprocessing
+import multiprocessing.pool
 import os
 import shutil
+import stat
+import struct
+import subprocess
 import sys
+import threading
+import time
+from distutils.spawn import find_executable
+import zlib
 
 # In Python 2.7, the core bz2 module can't process multi-stream files, such
 # as those produced by pbzip2.  In Python 3.4 and above, it can.  The 
@@ -78,6 +134,13 @@ import sys
 #     print >> sys.stderr, 'Could not import bz2file; using the core bz2.'
 #     import bz2
 
+# The batch engine needs NumPy.  Conditionally load it; without it all
+# reads go through the per-read filter() and trim() path.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Support the version command.
 cmd_folder = os.path.realpath(os.path.abspath(os.path.split(
     inspect.getfile(inspect.currentframe()))[0]))
@@ -92,33 +155,674 @@ except:
     sys.exit(2)
 
 
+class CompressedWriter(object):
+    """
+    A write-only file object that compresses what is written to it.
+
+    The data is cut into blocks, each compressed into a separate gzip
+    member on a pool of background threads (zlib releases the GIL), and
+    the members are written in order.  Any gzip reader handles the
+    concatenated members.  In BGZF mode the blocks are sized and tagged
+    as BGZF blocks, and the file ends with the BGZF EOF marker, so that
+    htslib based tools can index and seek into it.
+    """
+    # BGZF blocks must compress to at most 64 KiB; htslib fills them
+    # with this much data.
+    BGZF_BLOCK_SIZE = 0xff00
+    GZIP_BLOCK_SIZE = 1024 * 1024
+    BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC' \
+               '\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+    def __init__(self, f, bgzf=False, level=1, threads=2):
+        self.f = f
+        self.bgzf = bgzf
+        self.level = level
+        if bgzf:
+            self.block_size = CompressedWriter.BGZF_BLOCK_SIZE
+        else:
+            self.block_size = CompressedWriter.GZIP_BLOCK_SIZE
+        self.threads = max(1, threads)
+        self.pool = multiprocessing.pool.ThreadPool(self.threads)
+        self.pending = collections.deque()
+        self.buf = []
+        self.buf_len = 0
+        self.softspace = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buf_len += len(data)
+        if self.buf_len >= self.block_size:
+            data = ''.join(self.buf)
+            while len(data) >= self.block_size:
+                self.submit(data[:self.block_size])
+                data = data[self.block_size:]
+            self.buf = [data]
+            self.buf_len = len(data)
+
+    def submit(self, data):
+        """
+        Intended to be private to the class...
+
+        Queue a block for compression, and write the compressed blocks
+        that are done, keeping a bounded number of blocks in flight.
+        """
+        self.pending.append(self.pool.apply_async(
+            CompressedWriter.compress, (data, self.level, self.bgzf)))
+        while len(self.pending) > 2 * self.threads or \
+                (self.pending and self.pending[0].ready()):
+            self.f.write(self.pending.popleft().get())
+
+    def flush(self):
+        """
+        Compress and write everything written so far, ending the
+        current block, so the file can be cut here and still be read.
+        """
+        if self.buf_len:
+            self.submit(''.join(self.buf))
+            self.buf = []
+            self.buf_len = 0
+        while self.pending:
+            self.f.write(self.pending.popleft().get())
+        self.f.flush()
+
+    def tell(self):
+        """
+        :return: The size of the compressed file written so far; call
+        flush() first.
+        """
+        return self.f.tell()
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.flush()
+        if self.bgzf:
+            self.f.write(CompressedWriter.BGZF_EOF)
+        self.f.close()
+        self.pool.close()
+        self.pool.join()
+
+    @staticmethod
+    def compress(data, level, bgzf):
+        """
+        Intended to be private to the class...
+
+        Compress data into one gzip member, or one BGZF block.
+
+        :return: The compressed member.
+        """
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = c.compress(data) + c.flush()
+        trailer = struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+                              len(data) & 0xffffffff)
+        if bgzf:
+            # FEXTRA header with the BC subfield holding the total
+            # block size minus 1.
+            header = struct.pack('<4sIBBH2sHH', '\x1f\x8b\x08\x04', 0, 0,
+                                 255, 6, 'BC', 2, len(deflated) + 25)
+        else:
+            header = struct.pack('<4sIBB', '\x1f\x8b\x08\x00', 0, 0, 255)
+        return header + deflated + trailer
+
+    # End of class CompressedWriter.
+
+
+class DecompressedInput(object):
+    """
+    A gzip or bzip2 compressed input file, decompressed concurrently
+    with the parsing of its reads.
+
+    If pigz (for gzip) or pbzip2 (for bzip2) is on the PATH it does the
+    decompression in a separate process.  Otherwise a thread runs the
+    in-process gzip or bz2 module. Either way the decompressed data
+    arrives through a pipe in large blocks, and is read with the C
+    level readline() of a regular file object.
+    """
+    BLOCK_SIZE = 4 * 1024 * 1024
+
+    # Write ends of the pipes fed by decompression threads.  Processes
+    # forked while these are open must close them, or the reader never
+    # sees the end of the file.
+    write_fds = set()
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.seconds = None
+        self.proc = None
+        self.thread = None
+        self.error = None
+        if name.endswith('.gz'):
+            tool = find_executable('pigz')
+        else:
+            tool = find_executable('pbzip2')
+        if tool:
+            self.method = os.path.basename(tool)
+            self.proc = subprocess.Popen([tool, '-dc', name],
+                                         stdout=subprocess.PIPE,
+                                         bufsize=DecompressedInput.BLOCK_SIZE,
+                                         close_fds=True)
+            self.f = self.proc.stdout
+        else:
+            if name.endswith('.gz'):
+                self.method = 'gzip'
+            else:
+                self.method = 'bz2'
+            # Open here, so that a missing file raises IOError to our
+            # caller rather than in the thread.
+            compressed = FastqRead.open(name)
+            r, w = os.pipe()
+            DecompressedInput.write_fds.add(w)
+            self.f = os.fdopen(r, 'rb', DecompressedInput.BLOCK_SIZE)
+            self.thread = threading.Thread(target=self.decompress,
+                                           args=(compressed, w))
+            self.thread.daemon = True
+            self.thread.start()
+        # Bypass this object for the per-line calls.
+        self.readline = self.f.readline
+        self.read = self.f.read
+
+    def decompress(self, compressed, w):
+        """
+        Intended to be private to the class...
+
+        Thread body: copy the decompressed data into the pipe.
+        """
+        try:
+            with os.fdopen(w, 'wb', 0) as out:
+                while True:
+                    block = compressed.read(DecompressedInput.BLOCK_SIZE)
+                    if not block:
+                        break
+                    out.write(block)
+        except Exception as e:
+            self.error = e
+        finally:
+            DecompressedInput.write_fds.discard(w)
+            compressed.close()
+
+    def finish(self):
+        """
+        Called at the end of the file.  Record how long the file took to
+        read, and raise IOError if decompression failed.
+        """
+        if self.seconds is not None:
+            return
+        if self.proc:
+            status = self.proc.wait()
+            if status != 0:
+                self.error = '{0} exited with status {1}'.format(
+                    self.method, status)
+        else:
+            self.thread.join()
+        self.seconds = time.time() - self.start
+        self.f.close()
+        if self.error:
+            raise IOError('Could not decompress "{0}": {1}'.format(
+                self.name, self.error))
+
+    def close(self):
+        """
+        Stop reading the file before its end.  Closing the pipe ends
+        the decompressor.
+        """
+        self.f.close()
+        if self.proc:
+            self.proc.wait()
+
+    @staticmethod
+    def close_inherited():
+        """
+        Pool initializer for forked worker processes; see write_fds.
+        """
+        for w in list(DecompressedInput.write_fds):
+            try:
+                os.close(w)
+            except OSError:
+                pass
+        DecompressedInput.write_fds.clear()
+
+    # End of class DecompressedInput.
+
+
+class FastqRecords(object):
+    """
+    A batch of reads, as lists of the lines of each read.
+    """
+    def __init__(self):
+        self.names = []
+        self.bases = []
+        self.pluses = []
+        self.quals = []
+
+    def __len__(self):
+        return len(self.quals)
+
+    def append(self, name, bases, plus, qual):
+        self.names.append(name)
+        self.bases.append(bases)
+        self.pluses.append(plus)
+        self.quals.append(qual)
+
+    def read(self, n):
+        """
+        :return: The name, bases, plus and quality lines of read n.
+        """
+        return self.names[n], self.bases[n], self.pluses[n], self.quals[n]
+
+    def quality_matrix(self):
+        """
+        Pack the quality strings into a zero padded uint8 matrix, one
+        row per read.
+
+        :return: A tuple (matrix, read lengths, mask of the bases
+        within each read).
+        """
+        return FastqRecords.pack(self.quals)
+
+    def bases_matrix(self):
+        """
+        As quality_matrix(), for the bases.
+        """
+        return FastqRecords.pack(self.bases)
+
+    @staticmethod
+    def pack(lines):
+        """
+        Intended to be private to the class...
+
+        :param lines: A list of strings.
+        :return: A tuple (zero padded uint8 matrix, line lengths, mask
+        of the characters within each line).
+        """
+        lengths = numpy.array([len(l) for l in lines], dtype=numpy.int64)
+        width = lengths.max()
+        valid = numpy.arange(width) < lengths[:, numpy.newaxis]
+        matrix = numpy.zeros((len(lines), width), dtype=numpy.uint8)
+        matrix[valid] = numpy.frombuffer(''.join(lines), dtype=numpy.uint8)
+        return matrix, lengths, valid
+
+    # End of class FastqRecords.
+
+
+class FastqBlock(object):
+    """
+    A batch of reads held in one buffer, with the start and end offset
+    of each line.  Strings are only created for the reads that are
+    written; the quality matrix is gathered from the buffer directly.
+    """
+    # How much of the input file to read at a time.
+    BLOCK_SIZE = 8 * 1024 * 1024
+
+    # The characters str.strip() removes.
+    WHITESPACE = None
+
+    def __init__(self, buf, starts, ends):
+        self.buf = buf
+        self.starts = starts
+        self.ends = ends
+        # Python lists of the offsets, for read(); made on first use.
+        self.offsets = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    @staticmethod
+    def parse(buf, nl, first, last):
+        """
+        Intended to be private to the class...
+
+        Locate lines first to last (exclusive) of buf, stripped as
+        str.strip() would, grouped four to a read.  An incomplete read
+        at the end is padded with empty lines.
+
+        :param buf: The buffer.
+        :param nl: The offsets of the newlines in buf.
+        :param first: The index of the first line.
+        :param last: The index after the last line.
+        :return: A FastqBlock with a copy of just those lines.
+        """
+        if FastqBlock.WHITESPACE is None:
+            FastqBlock.WHITESPACE = numpy.zeros(256, dtype=bool)
+            FastqBlock.WHITESPACE[[9, 10, 11, 12, 13, 32]] = True
+        ends = numpy.array(nl[first:last], dtype=numpy.int64)
+        starts = numpy.empty_like(ends)
+        if len(ends):
+            starts[1:] = ends[:-1] + 1
+            if first:
+                starts[0] = nl[first - 1] + 1
+            else:
+                starts[0] = 0
+            offset = starts[0]
+            buf = buf[offset:ends[-1]]
+            starts -= offset
+            ends -= offset
+        else:
+            buf = ''
+        data = numpy.frombuffer(buf, dtype=numpy.uint8)
+        ws = FastqBlock.WHITESPACE
+        while len(data):
+            strip = (ends > starts) & ws[data[numpy.maximum(ends - 1, 0)]]
+            if not strip.any():
+                break
+            ends[strip] -= 1
+        while len(data):
+            strip = (ends > starts) & \
+                ws[data[numpy.minimum(starts, len(data) - 1)]]
+            if not strip.any():
+                break
+            starts[strip] += 1
+        pad = numpy.zeros(-len(ends) % 4, dtype=numpy.int64)
+        starts = numpy.append(starts, pad).reshape(-1, 4)
+        ends = numpy.append(ends, pad).reshape(-1, 4)
+        return FastqBlock(buf, starts, ends)
+
+    def first_incomplete(self):
+        """
+        All four lines must have content to be a valid read; the name
+        may be empty.
+
+        :return: The index of the first invalid read, or None.
+        """
+        empty = (self.ends[:, 1:] == self.starts[:, 1:]).any(axis=1)
+        if not empty.any():
+            return None
+        return int(empty.argmax())
+
+    def read(self, n):
+        """
+        :return: The name, bases, plus and quality lines of read n.
+        """
+        if self.offsets is None:
+            self.offsets = numpy.hstack((self.starts, self.ends)).tolist()
+        buf = self.buf
+        s0, s1, s2, s3, e0, e1, e2, e3 = self.offsets[n]
+        return buf[s0:e0], buf[s1:e1], buf[s2:e2], buf[s3:e3]
+
+    def quality_matrix(self):
+        """
+        Gather the quality lines into a zero padded uint8 matrix, one
+        row per read.
+
+        :return: A tuple (matrix, read lengths, mask of the bases
+        within each read).
+        """
+        return self.line_matrix(3)
+
+    def bases_matrix(self):
+        """
+        As quality_matrix(), for the bases.
+        """
+        return self.line_matrix(1)
+
+    def line_matrix(self, line):
+        """
+        Intended to be private to the class...
+
+        :param line: Which line of the reads to gather, 0-3.
+        :return: A tuple (zero padded uint8 matrix, line lengths, mask
+        of the characters within each line).
+        """
+        starts = self.starts[:, line]
+        lengths = self.ends[:, line] - starts
+        width = lengths.max()
+        columns = numpy.arange(width)
+        valid = columns < lengths[:, numpy.newaxis]
+        index = numpy.where(valid, starts[:, numpy.newaxis] + columns, 0)
+        matrix = numpy.frombuffer(self.buf, dtype=numpy.uint8)[index]
+        matrix[~valid] = 0
+        return matrix, lengths, valid
+
+    # End of class FastqBlock.
+
+
+class ReadHistograms(object):
+    """
+    Per-cycle quality and N content, and histograms of the quality
+    scores and trimmed lengths, of the reads of one end.  The counts
+    are indexed by cycle, quality character or length, so they don't
+    grow with the number of reads.
+    """
+    def __init__(self):
+        self.reads = 0
+        # Number of reads with a base at each cycle.
+        self.cycle_bases = []
+        # Sum of the quality characters at each cycle.
+        self.cycle_quality = []
+        # Number of N bases at each cycle.
+        self.cycle_n = []
+        # Number of bases with each quality character.
+        self.quality = [0] * 256
+        # Number of trimmed reads of each length.
+        self.lengths = []
+
+    @staticmethod
+    def add(counts, values):
+        """
+        Intended to be private to the class...
+
+        Add values to counts element by element, extending counts if
+        it is shorter.
+        """
+        if len(counts) < len(values):
+            counts.extend([0] * (len(values) - len(counts)))
+        for n, v in enumerate(values):
+            counts[n] += v
+
+    def add_read(self, bases, qual):
+        """
+        Count one untrimmed read.
+        """
+        self.reads += 1
+        for counts, size in ((self.cycle_bases, len(qual)),
+                             (self.cycle_quality, len(qual)),
+                             (self.cycle_n, len(bases))):
+            if len(counts) < size:
+                counts.extend([0] * (size - len(counts)))
+        cycle_bases = self.cycle_bases
+        cycle_quality = self.cycle_quality
+        quality = self.quality
+        for n, c in enumerate(qual):
+            c = ord(c)
+            cycle_bases[n] += 1
+            cycle_quality[n] += c
+            quality[c] += 1
+        cycle_n = self.cycle_n
+        for n, b in enumerate(bases):
+            if b == 'N' or b == 'n':
+                cycle_n[n] += 1
+
+    def add_batch(self, records):
+        """
+        Count a batch of untrimmed reads, with NumPy.
+
+        :param records: A FastqRecords or FastqBlock.
+        """
+        if not len(records):
+            return
+        self.reads += len(records)
+        matrix, lengths, valid = records.quality_matrix()
+        ReadHistograms.add(self.cycle_bases, valid.sum(axis=0).tolist())
+        ReadHistograms.add(self.cycle_quality,
+                           matrix.sum(axis=0, dtype=numpy.int64).tolist())
+        ReadHistograms.add(self.quality, numpy.bincount(
+            matrix[valid], minlength=256).tolist())
+        matrix = records.bases_matrix()[0]
+        ReadHistograms.add(self.cycle_n, ((matrix == ord('N')) |
+                                          (matrix == ord('n'))).
+                           sum(axis=0).tolist())
+
+    def add_length(self, length):
+        """
+        Count one read that was long enough after trimming.
+        """
+        if len(self.lengths) <= length:
+            self.lengths.extend([0] * (length + 1 - len(self.lengths)))
+        self.lengths[length] += 1
+
+    def merge(self, other):
+        """
+        Add the counts of another ReadHistograms to ours.
+        """
+        self.reads += other.reads
+        ReadHistograms.add(self.cycle_bases, other.cycle_bases)
+        ReadHistograms.add(self.cycle_quality, other.cycle_quality)
+        ReadHistograms.add(self.cycle_n, other.cycle_n)
+        ReadHistograms.add(self.quality, other.quality)
+        ReadHistograms.add(self.lengths, other.lengths)
+
+    def report(self, fastqs, offset=33):
+        """
+        :param fastqs: The input files of this end.
+        :param offset: The quality encoding offset.
+        :return: An OrderedDict of the statistics, for the JSON file.
+        Cycles and quality scores are numbered from 0.
+        """
+        report = collections.OrderedDict()
+        report['input_files'] = fastqs
+        report['reads'] = self.reads
+        report['quality_offset'] = offset
+        report['bases'] = sum(self.cycle_bases)
+        report['n_bases'] = sum(self.cycle_n)
+        report['per_cycle_bases'] = self.cycle_bases
+        report['per_cycle_mean_quality'] = [
+            round(float(q) / b - offset, 2) if b else None
+            for q, b in zip(self.cycle_quality, self.cycle_bases)]
+        report['per_cycle_n_count'] = self.cycle_n
+        report['quality_histogram'] = [
+            [c - offset, count] for c, count in enumerate(self.quality)
+            if count]
+        report['trimmed_length_histogram'] = [
+            [length, count] for length, count in enumerate(self.lengths)
+            if count]
+        return report
+
+    # End of class ReadHistograms.
+
+
+class QualityCriteria(object):
+    """
+    The filter and trim quality thresholds compiled into translation
+    tables, so that counting the low quality bases of a read or
+    finding its first and last high quality bases is one pass of
+    str.translate() and str.find() in C instead of a Python loop.
+    """
+    # Lowest quality character of each encoding.
+    LOWEST = {33: '!', 64: '@'}
+
+    def __init__(self, read_hq=30, trim_hq=30, offset=33):
+        self.offset = offset
+        self.read_hq = chr(int(read_hq) + offset)
+        self.trim_hq = chr(int(trim_hq) + offset)
+        # Deleting the high quality characters leaves the low quality
+        # ones.
+        self.filter_hq = ''.join(chr(c) for c in
+                                 range(ord(self.read_hq), 256))
+        # Marks high quality bases '1' and the rest '0'.
+        self.trim_table = ''.join('0' if c < ord(self.trim_hq) else '1'
+                                  for c in range(256))
+
+    def low_quality(self, qual):
+        """
+        :param qual: The quality string of a read.
+        :return: The number of low quality bases, by the filter
+        threshold.
+        """
+        return len(qual.translate(None, self.filter_hq))
+
+    def trim_points(self, qual, trim_5=False):
+        """
+        :param qual: The quality string of a read.
+        :param trim_5: Whether to trim the 5' end too.
+        :return: A tuple (p5, p3) of the first and last high quality
+        bases by the trim threshold; the same as the per-base loops
+        in FastqRead.trim() gave, also when there are none.
+        """
+        marks = qual.translate(self.trim_table)
+        p3 = marks.rfind('1')
+        if p3 < 0:
+            if trim_5:
+                return len(qual) - 1, 0
+            return 0, 0
+        if trim_5:
+            return marks.find('1'), p3
+        return 0, p3
+
+    @staticmethod
+    def detect_offset(fastqs, records=10000):
+        """
+        Guess the quality encoding from the lowest quality character
+        in the first records reads of each file.  Named pipes are not
+        sampled, since what is read from them would be lost.
+
+        :param fastqs: The first input file of each end.
+        :param records: The number of reads to sample per file.
+        :return: 33 or 64, or None if there was nothing to sample.
+        """
+        lowest = None
+        for name in fastqs:
+            if stat.S_ISFIFO(os.stat(name).st_mode):
+                continue
+            f = FastqRead.open(name)
+            try:
+                for n in xrange(records):
+                    if not f.readline():
+                        break
+                    f.readline()
+                    f.readline()
+                    qual = f.readline().rstrip('\r\n')
+                    if qual and (lowest is None or min(qual) < lowest):
+                        lowest = min(qual)
+            finally:
+                f.close()
+        if lowest is None:
+            return None
+        if lowest < QualityCriteria.LOWEST[64]:
+            return 33
+        return 64
+
+    # End of class QualityCriteria.
+
+
 # The guts of this program.  All processing of reads.
 class FastqRead(object):
     trim_5 = False
     trim_hq = 30
     read_hq = 30
     pct_hq = 0.7
-
-    def __init__(self, fastqs, odir=None, suffix='_filtered_trimmed'):
-        ofn = os.path.split(fastqs[0])[1] + suffix
-        # ofn_path = fastqs[1]
-
-        if odir:
-            ofn_path = os.path.join(odir, ofn)
+    phred_offset = 33
+    criteria = QualityCriteria()
+
+    def __init__(self, fastqs, odir=None, suffix='_filtered_trimmed',
+                 compress=None, compress_level=1, compress_threads=2,
+                 parallel_decompress=False, histograms=False, of=None,
+                 output_offset=None):
+        # An output passed in is shared with the other end, to write
+        # the pairs interleaved; the caller closes it.
+        self.shared_output = of is not None
+        if of is None:
+            ofn_path = FastqRead.output_name(fastqs, odir, suffix,
+                                             compress)
+            of = FastqRead.create(ofn_path, compress, compress_level,
+                                  compress_threads, output_offset)
         else:
-            ofn_path = ofn
-        try:
-            self.of = open(ofn_path, 'w')
-        except IOError:
-            print >> sys.stderr, \
-            'Could not open "{0}". Exiting.'.format(ofn_path)
-            sys.exit(1)
+            ofn_path = None
+        self.ofn_path = ofn_path
+        self.of = of
 
-        print
-        ofn_path
         self.fastqs = fastqs
         self.fn = None
         self.f = None
+        # Index in the file list of the current file, and offset in it
+        # of the next read.
+        self.file_index = -1
+        self.offset = 0
+        self.parallel_decompress = parallel_decompress
+        self.input_rates = []
+        self.histograms = None
+        if histograms:
+            self.histograms = ReadHistograms()
         self.total_reads = 0
         self.hq_reads = 0
         self.output_reads = 0
@@ -130,6 +834,14 @@ class FastqRead(object):
         self.bases = ''
         self.plus = ''
         self.qual = ''
+        self.batch = None
+        # Input read by read_block() not parsed yet, and its offset in
+        # the file.
+        self.buf = ''
+        self.buf_start = 0
+        self.nl = []
+        self.line = 0
+        self.eof = False
         self.timestamp = False
         self.line_count = 0
 
@@ -143,11 +855,22 @@ class FastqRead(object):
 
         self.fn = self.fastqs.pop(0)
         try:
-            self.f = FastqRead.open(self.fn)
-        except IOError:
+            if self.parallel_decompress and \
+                    self.fn.endswith(('.gz', '.bz2')):
+                self.f = DecompressedInput(self.fn)
+            else:
+                self.f = FastqRead.open(self.fn)
+        except (IOError, OSError):
             print >> sys.stderr, \
             'Could not open "{0}". Exiting.'.format(self.fn)
             sys.exit(1)
+        self.file_index += 1
+        self.offset = 0
+        self.buf = ''
+        self.buf_start = 0
+        self.nl = []
+        self.line = 0
+        self.eof = False
         return True
 
     def get_filename(self):
@@ -159,9 +882,8 @@ class FastqRead(object):
         Intended to be private to the class...
         A flexible open routine that can handle plain text files or
         files compressed with gzip or bzip2.  Only used for the
-        input files. Output files are emitted uncompressed, until the
-        tools in the next leg of the pipeline can work properly with
-        compressed files.
+        input files. Output files are emitted uncompressed unless
+        compression is requested; see CompressedWriter.
         :param name: The filename to open.
         :return: A file object for the named file.
         """
@@ -173,6 +895,55 @@ class FastqRead(object):
             f = open(name)
         return f
 
+    @staticmethod
+    def output_name(fastqs, odir=None, suffix='_filtered_trimmed',
+                    compress=None):
+        """
+        :return: The name of the output file for the end whose input
+        files are fastqs.
+        """
+        ofn = os.path.split(fastqs[0])[1] + suffix
+        # ofn_path = fastqs[1]
+        if compress:
+            ofn += '.gz'
+        if odir:
+            return os.path.join(odir, ofn)
+        return ofn
+
+    @staticmethod
+    def create(name, compress=None, compress_level=1, compress_threads=2,
+               offset=None):
+        """
+        Open an output file for the filtered, trimmed reads.  "-" is
+        the standard output.  If the file is a named pipe, this waits
+        for a reader, such as bwa mem or Xenome, to open the other end.
+
+        :param name: The filename to open.
+        :param compress: None, 'gzip' or 'bgzf'.
+        :param compress_level: The compression level.
+        :param compress_threads: The number of compression threads.
+        :param offset: When resuming, keep the existing file up to
+        this offset and append to it.
+        :return: A file object for the named file.
+        """
+        try:
+            if name == '-':
+                f = sys.stdout
+            elif offset is not None:
+                f = open(name, 'r+b')
+                f.truncate(offset)
+                f.seek(offset)
+            else:
+                f = open(name, 'wb')
+            if compress:
+                return CompressedWriter(f, compress == 'bgzf',
+                                        compress_level, compress_threads)
+            return f
+        except (IOError, OSError):
+            print >> sys.stderr, \
+                'Could not open "{0}". Exiting.'.format(name)
+            sys.exit(1)
+
     def stats(self):
         s = {}
         s['total_reads'] = self.total_reads
@@ -198,11 +969,16 @@ class FastqRead(object):
         # Test whether we had a successful read.
         #  Will be zero length if EOF reached.
         if not name:
+            self.end_file()
             return False
+        bases = self.f.readline()
+        plus = self.f.readline()
+        qual = self.f.readline()
+        self.offset += len(name) + len(bases) + len(plus) + len(qual)
         self.name = name.strip()
-        self.bases = self.f.readline().strip()
-        self.plus = self.f.readline().strip()
-        self.qual = self.f.readline().strip()
+        self.bases = bases.strip()
+        self.plus = plus.strip()
+        self.qual = qual.strip()
 
         # All four lines must have content to be a valid read.
         if len(self.bases) == 0 or \
@@ -216,6 +992,8 @@ class FastqRead(object):
                              format(self.fn))
 
         self.total_reads += 1
+        if self.histograms is not None:
+            self.histograms.add_read(self.bases, self.qual)
         if self.timestamp:
             self.line_count += 1
             if self.line_count % 1000000 == 0:
@@ -228,21 +1006,306 @@ class FastqRead(object):
     def do_timestamp(self):
         self.timestamp = True
 
+    def end_file(self):
+        """
+        Intended to be private to the class...
+
+        Called when the current input file is exhausted.  With parallel
+        decompression, record the file's read rate.
+        """
+        if not isinstance(self.f, DecompressedInput) or \
+                self.f.seconds is not None:
+            return
+        self.f.finish()
+        mb = os.path.getsize(self.fn) / 1048576.0
+        self.input_rates.append((self.fn, self.f.method, mb,
+                                 self.f.seconds))
+
+    def next_batch(self, size):
+        """
+        Read up to size reads from the current input file and compute
+        the filter result and trim points for all of them at once.
+        The reads are then processed one by one with batch_filter()
+        and batch_trim().
+
+        :param size: The maximum number of reads to retrieve.
+        :return: The number of reads retrieved. Fewer than size means
+        the current input file is exhausted.
+        """
+        n = self.read_batch(size)
+        self.evaluate()
+        return n
+
+    def read_batch(self, size):
+        """
+        Read up to size reads from the current input file, without
+        evaluating them.  With NumPy the file is parsed a block at a
+        time by read_block(); otherwise read by read with next().
+
+        :param size: The maximum number of reads to retrieve.
+        :return: The number of reads retrieved. Fewer than size means
+        the current input file is exhausted.
+        """
+        if numpy is not None:
+            records = self.read_block(size)
+        else:
+            records = FastqRecords()
+            while len(records) < size and self.next():
+                records.append(self.name, self.bases, self.plus, self.qual)
+        self.batch = (records, None, None, None)
+        return len(records)
+
+    def read_block(self, size):
+        """
+        Intended to be private to the class...
+
+        Parse up to size reads out of large blocks of the input file,
+        locating the lines by their offsets instead of reading them
+        one by one.  The same checks as next() are applied.
+
+        :param size: The maximum number of reads to retrieve.
+        :return: A FastqBlock with the reads.
+        """
+        # Make sure there are size reads buffered, or all that's left.
+        while len(self.nl) - self.line < 4 * size and not self.eof:
+            data = self.f.read(FastqBlock.BLOCK_SIZE)
+            if not data:
+                self.eof = True
+                # A last line without a newline still counts as a line.
+                if self.buf and not self.buf.endswith('\n'):
+                    data = '\n'
+            if self.line:
+                used = self.nl[self.line - 1] + 1
+                self.buf = self.buf[used:]
+                self.buf_start += used
+                self.line = 0
+            self.buf += data
+            self.nl = numpy.flatnonzero(
+                numpy.frombuffer(self.buf, dtype=numpy.uint8) == 10)
+
+        count = min(size, (len(self.nl) - self.line) // 4)
+        first = self.line
+        self.line += 4 * count
+        if self.line:
+            self.offset = self.buf_start + int(self.nl[self.line - 1]) + 1
+        block = FastqBlock.parse(self.buf, self.nl, first, self.line)
+        bad = block.first_incomplete()
+        if bad is None and count < size and len(self.nl) > self.line:
+            # The file ends in the middle of a read.
+            block = FastqBlock.parse(self.buf, self.nl, self.line,
+                                     len(self.nl))
+            bad = 0
+        if bad is not None:
+            self.name, self.bases, self.plus, self.qual = block.read(bad)
+            print >> sys.stderr, 'NAME:', self.name
+            print >> sys.stderr, 'BASES:', self.bases
+            print >> sys.stderr, 'PLUS:', self.plus
+            print >> sys.stderr, 'QUAL:', self.qual
+            raise ValueError('Incomplete read found in file {0}'.
+                             format(self.fn))
+
+        self.total_reads += count
+        if self.timestamp:
+            before = self.line_count
+            self.line_count += count
+            for n in xrange((before // 1000000 + 1) * 1000000,
+                            self.line_count + 1, 1000000):
+                print >> sys.stderr,  \
+                    datetime.datetime.strftime(datetime.datetime.now(),
+                                               '%H:%M:%S'), \
+                    n
+        if count < size:
+            self.end_file()
+        return block
+
+    def evaluate(self):
+        """
+        Compute the filter result and trim points for the current
+        batch, if NumPy is available.  Otherwise batch_filter() and
+        batch_trim() fall back to filter() and trim().  The reads are
+        added to the histograms here; without NumPy, next() did that.
+        """
+        if numpy is not None:
+            records = self.batch[0]
+            self.batch = (records,) + FastqRead.evaluate_batch(records)
+            if self.histograms is not None:
+                self.histograms.add_batch(records)
+
+    @staticmethod
+    def evaluate_batch(records):
+        """
+        Intended to be private to the class...
+
+        Vectorized equivalent of the per-base loops in filter() and
+        trim(), on the zero padded quality matrix of the reads.
+
+        :param records: A FastqRecords or FastqBlock.
+        :return: A tuple of arrays (passed filter, 5' trim point,
+        3' trim point), one element per read.
+        """
+        if not len(records):
+            return None, None, None
+        matrix, lengths, valid = records.quality_matrix()
+        width = matrix.shape[1]
+
+        # filter(): the read passes unless it has more low quality bases
+        # than allowed.  Same float arithmetic as the per-read path.
+        lq_bases = ((matrix < ord(FastqRead.read_hq)) & valid).sum(axis=1)
+        lq_allowed = numpy.floor(lengths.astype(numpy.float64) *
+                                 (1.0 - FastqRead.pct_hq))
+        passed = lq_bases <= lq_allowed
+
+        # trim(): the first and last high quality bases.  If there are
+        # none, the per-read loops leave p5 at the last base and p3 at
+        # the first one.
+        hq = (matrix >= ord(FastqRead.trim_hq)) & valid
+        any_hq = hq.any(axis=1)
+        if FastqRead.trim_5:
+            p5 = numpy.where(any_hq, hq.argmax(axis=1), lengths - 1)
+        else:
+            p5 = numpy.zeros(len(lengths), dtype=numpy.int64)
+        p3 = numpy.where(any_hq, width - 1 - hq[:, ::-1].argmax(axis=1), 0)
+        return passed, p5, p3
+
+    def batch_filter(self, n):
+        """
+        Apply the filter result computed by next_batch() to read n of
+        the current batch.  Without a precomputed result, make it the
+        current read and filter() it.
+
+        :param n: Index of the read in the batch.
+        :return: True if the read passed HQ filtering criteria
+        """
+        records, passed = self.batch[:2]
+        if passed is None:
+            self.name, self.bases, self.plus, self.qual = records.read(n)
+            return self.filter()
+        if not passed[n]:
+            return False
+        self.hq_reads += 1
+        return True
+
+    def batch_trim(self, n):
+        """
+        Make read n of the current batch the current read and trim it
+        at the points computed by next_batch(). batch_filter(n) must
+        have been called first.
+
+        :param n: Index of the read in the batch.
+        :return:  True if the read is long enough after trimming.
+        """
+        records, passed, p5, p3 = self.batch
+        if p5 is None:
+            return self.trim()
+        self.name, self.bases, self.plus, self.qual = records.read(n)
+        return self.trim_at(int(p5[n]), int(p3[n]))
+
+    def merge(self, shard):
+        """
+        Add the output and statistics of a chunk of reads processed by
+        a FastqShard to ours.  The reads were already counted in
+        total_reads when they were read.
+
+        :param shard: The result of FastqShard.result().
+        :return: None
+        """
+        output, hq_reads, output_reads, min_trimmed_length, \
+            max_trimmed_length, total_trimmed_length, trimmed_reads, \
+            histograms = shard
+        self.of.write(output)
+        self.hq_reads += hq_reads
+        self.output_reads += output_reads
+        if max_trimmed_length > self.max_trimmed_length:
+            self.max_trimmed_length = max_trimmed_length
+        if min_trimmed_length < self.min_trimmed_length:
+            self.min_trimmed_length = min_trimmed_length
+        self.total_trimmed_length += total_trimmed_length
+        self.trimmed_reads += trimmed_reads
+        if histograms is not None:
+            self.histograms.merge(histograms)
+
+    # The statistics saved in a checkpoint.
+    COUNTERS = ('total_reads', 'hq_reads', 'output_reads',
+                'min_trimmed_length', 'max_trimmed_length',
+                'total_trimmed_length', 'trimmed_reads', 'line_count')
+
+    def checkpoint(self):
+        """
+        Flush the output to disk and describe how far we have got.
+        Every read read so far must have been processed and written.
+
+        :return: A dict of the state, for restore().
+        """
+        self.of.flush()
+        os.fsync(self.of.fileno())
+        state = collections.OrderedDict()
+        state['file'] = self.file_index
+        state['input'] = self.fn
+        state['offset'] = self.offset
+        state['output_offset'] = self.of.tell()
+        for key in FastqRead.COUNTERS:
+            state[key] = getattr(self, key)
+        state['input_rates'] = self.input_rates
+        if self.histograms is not None:
+            state['histograms'] = vars(self.histograms)
+        return state
+
+    def restore(self, state):
+        """
+        Carry on from a checkpoint: move to the input file and offset
+        it recorded, and restore the statistics.  The output must have
+        been reopened at the recorded offset.
+
+        :param state: A dict from checkpoint().
+        :return: None
+        """
+        if state['file'] != self.file_index:
+            self.f.close()
+            self.fastqs = self.fastqs[state['file'] - self.file_index - 1:]
+            self.next_file()
+            # next_file() counts from where we were, not the file skipped to.
+            self.file_index = state['file']
+        if self.fn != state['input']:
+            print >> sys.stderr, 'Checkpoint is at "{0}", but input ' \
+                                 'file {1} is "{2}". Exiting.'.format(
+                state['input'], state['file'] + 1, self.fn)
+            sys.exit(1)
+        offset = state['offset']
+        if isinstance(self.f, DecompressedInput):
+            # A pipe; read our way to the offset.
+            while offset:
+                data = self.f.read(min(offset, FastqBlock.BLOCK_SIZE))
+                if not data:
+                    break
+                offset -= len(data)
+        else:
+            self.f.seek(offset)
+        self.offset = self.buf_start = state['offset']
+        for key in FastqRead.COUNTERS:
+            setattr(self, key, state[key])
+        self.input_rates = [tuple(rate) for rate in state['input_rates']]
+        if self.histograms is not None:
+            vars(self.histograms).update(state['histograms'])
+
     @staticmethod
     def set_criteria(pct_hq=0.7,
                      read_hq=30,
                      trim_hq=30,
                      trim_5=False,
                      min_pct=0.7,
-                     min_pct_hq_reads=0.0):
+                     min_pct_hq_reads=0.0,
+                     phred_offset=33):
 
         FastqRead.pct_hq = float(pct_hq)
         if FastqRead.pct_hq > 1.0:
             FastqRead.pct_hq /= 100.0
 
-        # Use phred33 quality scoring
-        FastqRead.read_hq = chr(int(read_hq) + 33)
-        FastqRead.trim_hq = chr(int(trim_hq) + 33)
+        # Phred+33 quality scoring, unless told otherwise.
+        FastqRead.phred_offset = phred_offset
+        FastqRead.criteria = QualityCriteria(read_hq, trim_hq,
+                                             phred_offset)
+        FastqRead.read_hq = FastqRead.criteria.read_hq
+        FastqRead.trim_hq = FastqRead.criteria.trim_hq
         FastqRead.trim_5 = trim_5  # Passed in as boolean
         FastqRead.min_pct = float(min_pct)
         if FastqRead.min_pct > 1.0:
@@ -259,18 +1322,21 @@ class FastqRead(object):
         :return:  True if the read is long enough after trimming.
         """
 
-        original_length = len(self.qual)
-        if FastqRead.trim_5:
-            for p5 in range(original_length):
-                if self.qual[p5] >= FastqRead.trim_hq:
-                    break
-        else:
-            p5 = 0
+        p5, p3 = FastqRead.criteria.trim_points(self.qual,
+                                                FastqRead.trim_5)
+        return self.trim_at(p5, p3)
 
-        for p3 in range(original_length - 1, -1, -1):
-            if self.qual[p3] >= FastqRead.trim_hq:
-                break
+    def trim_at(self, p5, p3):
+        """
+        Intended to be private to the class...
 
+        Trim the current read to the bases from p5 to p3, inclusive.
+
+        :param p5: Index of the first base kept.
+        :param p3: Index of the last base kept.
+        :return:  True if the read is long enough after trimming.
+        """
+        original_length = len(self.qual)
         tlg = (p3 - p5) + 1  # Length after trimming.
 
         if FastqRead.min_len is None:
@@ -291,6 +1357,8 @@ class FastqRead(object):
             self.min_trimmed_length = tlg
         self.total_trimmed_length += tlg  # To compute the mean
         self.trimmed_reads += 1
+        if self.histograms is not None:
+            self.histograms.add_length(tlg)
         return True
 
     def filter(self):
@@ -300,12 +1368,8 @@ class FastqRead(object):
         lg = len(self.qual)
         lq_reads_allowed = math.floor(float(lg) *
                                       (1.0 - FastqRead.pct_hq))
-        lq_reads = 0
-        for n in range(lg):
-            if self.qual[n] < FastqRead.read_hq:
-                lq_reads += 1
-                if lq_reads > lq_reads_allowed:
-                    return False
+        if FastqRead.criteria.low_quality(self.qual) > lq_reads_allowed:
+            return False
         self.hq_reads += 1
         return True
 
@@ -317,11 +1381,158 @@ class FastqRead(object):
         self.output_reads += 1
 
     def close(self):
-        self.of.close()
+        if not self.shared_output:
+            self.of.close()
 
     # End of class FastqRead.
 
 
+class FastqShard(FastqRead):
+    """
+    A chunk of reads filtered and trimmed in a worker process.  The
+    output is collected in memory and handed back to the main process
+    with the statistics, to be merged in the original read order.
+    """
+    def __init__(self, records, histograms=False, of=None):
+        self.shared_output = of is not None
+        if of is None:
+            of = cStringIO.StringIO()
+        self.of = of
+        self.fastqs = []
+        self.fn = None
+        self.f = None
+        self.histograms = None
+        if histograms:
+            self.histograms = ReadHistograms()
+        self.total_reads = 0
+        self.hq_reads = 0
+        self.output_reads = 0
+        self.min_trimmed_length = sys.maxint
+        self.max_trimmed_length = -1
+        self.total_trimmed_length = 0
+        self.trimmed_reads = 0
+        self.name = ''
+        self.bases = ''
+        self.plus = ''
+        self.qual = ''
+        self.batch = (records, None, None, None)
+        self.timestamp = False
+        self.line_count = 0
+        self.evaluate()
+
+    def result(self):
+        output = ''
+        if not self.shared_output:
+            output = self.of.getvalue()
+        return (output, self.hq_reads, self.output_reads,
+                self.min_trimmed_length, self.max_trimmed_length,
+                self.total_trimmed_length, self.trimmed_reads,
+                self.histograms)
+
+    # End of class FastqShard.
+
+
+class Checkpoint(object):
+    """
+    Saves how far the run has got every interval reads, so that a run
+    that was killed can be carried on with --resume.  Each checkpoint is
+    written to a temporary file and renamed over the previous one, so
+    there is always one complete checkpoint.
+    """
+    # The arguments that must be the same to resume a run.
+    SETTINGS = ('fastqs', 'single_end', 'hq_pct', 'filter_hq', 'trim_hq',
+                'min_len_pct', 'trim_5', 'suffix', 'compress',
+                'interleaved', 'histograms', 'phred')
+
+    def __init__(self, name, interval, args):
+        self.name = name
+        self.interval = interval
+        self.next = interval
+        self.settings = collections.OrderedDict(
+            (key, getattr(args, key)) for key in Checkpoint.SETTINGS)
+
+    def due(self, reads):
+        """
+        :param reads: The number of reads per end read so far.
+        :return: True if it is time to save a checkpoint.
+        """
+        return self.interval > 0 and reads >= self.next
+
+    def schedule(self, reads):
+        """
+        Intended to be private to the class...
+
+        Set the read count of the next checkpoint.
+        """
+        if self.interval > 0:
+            self.next = (reads // self.interval + 1) * self.interval
+
+    def save(self, r1, r2):
+        """
+        Save a checkpoint.  Every read read so far must have been
+        processed and written.
+
+        :param r1: The end 1 reads.
+        :param r2: The end 2 reads, or None for a single end run.
+        :return: None
+        """
+        state = collections.OrderedDict()
+        state['settings'] = self.settings
+        state['min_len'] = FastqRead.min_len
+        state['ends'] = [r.checkpoint() for r in (r1, r2) if r is not None]
+        tmp = self.name + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.name)
+        self.schedule(r1.total_reads)
+
+    def load(self):
+        """
+        :return: The last checkpoint saved, or None if there is none.
+        Exits if it was saved by a run with different settings.
+        """
+        try:
+            with open(self.name) as f:
+                state = json.load(f)
+        except IOError:
+            return None
+        if state['settings'] != self.settings:
+            print >> sys.stderr, 'Checkpoint "{0}" is from a run with ' \
+                                 'different arguments. Exiting.'.format(
+                self.name)
+            sys.exit(1)
+        return state
+
+    def restore(self, state, r1, r2):
+        """
+        Carry on from a checkpoint returned by load().  The outputs
+        must have been reopened at their recorded offsets.
+
+        :param state: The checkpoint.
+        :param r1: The end 1 reads.
+        :param r2: The end 2 reads, or None for a single end run.
+        :return: None
+        """
+        FastqRead.min_len = state['min_len']
+        r1.restore(state['ends'][0])
+        if r2 is not None:
+            r2.restore(state['ends'][1])
+        self.schedule(r1.total_reads)
+
+    def remove(self):
+        """
+        The run is complete; delete the checkpoint.
+        """
+        try:
+            os.remove(self.name)
+        except OSError:
+            pass
+
+    # End of class Checkpoint.
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Perform filtering and trimming of paired end fastq files",
                                      usage='%(prog)s [options]')
@@ -343,11 +1554,84 @@ def parse_args():
     parser.add_argument('-d', '--directory', dest='odir', default='.',
                         help='Directory in which to write the output files [current directory]')
     parser.add_argument('-i', '--timestamp', action='store_true', help='Emit a timestamp ever 1,000,000 reads [False]')
+    parser.add_argument('-b', '--batch_size', type=int, default=0, help='Number of reads per end to filter and trim at '
+                                                                       'a time with NumPy; 0 filters read by read [0]')
+    parser.add_argument('-P', '--processes', type=int, default=1, help='Number of worker processes to filter and trim '
+                                                                       'chunks of --batch_size reads (10,000 if 0) [1]')
+    parser.add_argument('-z', '--compress', choices=['gzip', 'bgzf'],
+                        help='Compress the output files, as gzip or as block gzip (BGZF) [uncompressed]')
+    parser.add_argument('-Z', '--compress_level', type=int, default=1, choices=range(1, 10),
+                        help='Compression level for --compress, 1-9 [1]')
+    parser.add_argument('--compress_threads', type=int, default=2,
+                        help='Number of threads compressing each output file [2]')
+    parser.add_argument('-D', '--parallel_decompress', action='store_true',
+                        help='Decompress gzip and bzip2 input with pigz or pbzip2, or in a separate thread, and report '
+                             'the read rate of each input file [False]')
+    parser.add_argument('-H', '--histograms', action='store_true',
+                        help='Write per-cycle quality and N content, and quality score and trimmed length histograms, '
+                             'to a JSON file next to the statistics file [False]')
+    parser.add_argument('-I', '--interleaved', metavar='FILE',
+                        help='Write the reads of both ends interleaved to FILE, or to the standard output if FILE is '
+                             '"-" [one file per end]')
+    parser.add_argument('-F', '--fifo', action='store_true',
+                        help='Create the output files as named pipes, to be read by a process started alongside this '
+                             'one [False]')
+    parser.add_argument('-c', '--checkpoint', type=int, default=0, metavar='READS',
+                        help='Save a checkpoint every READS reads per end, to carry on with --resume if the run is '
+                             'killed; 0 saves none [0]')
+    parser.add_argument('-R', '--resume', action='store_true',
+                        help='Resume from the checkpoint of an earlier run with the same arguments, if there is one '
+                             '[False]')
+    parser.add_argument('--phred', choices=['33', '64', 'auto'], default='33',
+                        help='Quality encoding offset; "auto" detects it from the first 10,000 reads [33]')
     parser.add_argument("fastqs", nargs="+")
     args = parser.parse_args()
     return args
 
 
+def output_input_rates(sf, reads):
+    """
+    Write the read rate of each input file decompressed with
+    --parallel_decompress to the statistics file.
+
+    :param sf: The open statistics file.
+    :param reads: The FastqRead of each end.
+    :return: None
+    """
+    rates = [rate for r in reads for rate in r.input_rates]
+    if not rates:
+        return
+    print >> sf, 'Input decompression'
+    print >> sf, 'File\tDecompressor\tMB\tSeconds\tMB/s'
+    for fn, method, mb, seconds in rates:
+        try:
+            rate = '{0:.2f}'.format(mb / seconds)
+        except ZeroDivisionError:
+            rate = 'N/A'
+        print >> sf, '{0}\t{1}\t{2:.2f}\t{3:.2f}\t{4}'.format(
+            fn, method, mb, seconds, rate)
+
+
+def output_histograms(name, reads, fastqs):
+    """
+    Write the histograms collected with --histograms to a JSON file.
+
+    :param name: The name of the JSON file.
+    :param reads: The FastqRead of each end.
+    :param fastqs: The input files of each end.
+    :return: None
+    """
+    if reads[0].histograms is None:
+        return
+    report = collections.OrderedDict()
+    for n, r in enumerate(reads):
+        report['Read {0}'.format(n + 1)] = \
+            r.histograms.report(fastqs[n], FastqRead.phred_offset)
+    with open(name, 'w') as f:
+        json.dump(report, f, indent=1, separators=(',', ': '))
+        print >> f
+
+
 def output_stats_single(r1, args, start_time):
     """
     Report the statistics for a single end run.
@@ -367,7 +1651,8 @@ def output_stats_single(r1, args, start_time):
     r1_stats = r1.stats()
     bn_fq1 = os.path.split(args.fastqs[0])[1]
 
-    with open(os.path.join(args.odir, bn_fq1 + '_stat'), 'w') as sf:
+    stat_name = os.path.join(args.odir, bn_fq1 + '_stat')
+    with open(stat_name, 'w') as sf:
         print >> sf, 'Input file:'
         print >> sf, 'Read 1: {0}'.format(args.fastqs[::2])
         print >> sf, 'QC statistics'
@@ -407,6 +1692,8 @@ def output_stats_single(r1, args, start_time):
         end_time = datetime.datetime.now()
         print >> sf, 'Run end time\t{0}'. \
             format(datetime.datetime.strftime(end_time, '%H:%M:%S'))
+        output_input_rates(sf, [r1])
+        output_histograms(stat_name + '.json', [r1], [args.fastqs[::2]])
 
         if r1_stats['total_reads'] == 0:
             # This will be the same as sys.exit(6)
@@ -447,8 +1734,9 @@ def output_stats_paired(r1, r2, args, start_time):
     bn_fq1 = os.path.split(args.fastqs[0])[1]
     bn_fq2 = os.path.split(args.fastqs[1])[1]
 
-    with open(os.path.join(args.odir,
-                           '{0}_{1}_stat'.format(bn_fq1, bn_fq2)), 'w') as sf:
+    stat_name = os.path.join(args.odir,
+                             '{0}_{1}_stat'.format(bn_fq1, bn_fq2))
+    with open(stat_name, 'w') as sf:
         print >> sf, 'Input files:'
         print >> sf, 'Read 1: {0}'.format(args.fastqs[::2])
         print >> sf, 'Read 2: {0}'.format(args.fastqs[1::2])
@@ -506,6 +1794,9 @@ def output_stats_paired(r1, r2, args, start_time):
         end_time = datetime.datetime.now()
         print >> sf, 'Run end time\t{0}'. \
             format(datetime.datetime.strftime(end_time, '%H:%M:%S'))
+        output_input_rates(sf, [r1, r2])
+        output_histograms(stat_name + '.json', [r1, r2],
+                          [args.fastqs[::2], args.fastqs[1::2]])
 
         if r1_stats['total_reads'] == 0 or r2_stats['total_reads'] == 0:
             # This will be the same as sys.exit(6)
@@ -525,49 +1816,16 @@ def output_stats_paired(r1, r2, args, start_time):
         return 0
 
 
-def main():
-    start_time = datetime.datetime.now()
-    args = parse_args()
-
-    # If we are doing paired end processing, make sure that we have
-    # pairs (i.e., an even number of files, and split the list of
-    # files into end-specific lists.
-    num_fastqs = len(args.fastqs)
-    paired_end = ((num_fastqs != 1) and (not args.single_end))
-
-    if paired_end:
-        # Paired end; need to be an even number of fastqs.
-        if num_fastqs % 2 != 0:
-            print >> sys.stderr, 'Odd number of fastq files ({0}) in ' \
-                                 'paired-end mode. Exiting...'.format(
-                num_fastqs
-            )
-            sys.exit(4)
-
-        # Now split the lists:
-        e1_fastqs = args.fastqs[::2]
-        e2_fastqs = args.fastqs[1::2]
-    else:
-        # Make a copy.  We need the original later.
-        e1_fastqs = args.fastqs[:]
-        e2_fastqs = None
-
-    r1 = FastqRead(e1_fastqs, args.odir, args.suffix)
-
-    # We may be processing single end reads.  Everything with r2 is
-    # conditional on having a second fastq.
-    if paired_end:
-        r2 = FastqRead(e2_fastqs, args.odir, args.suffix)
-
-    # Check if we want timestamps output to track progress
-    if args.timestamp:
-        r1.do_timestamp()
-
-    # The criteria are class members, not instance.
-    FastqRead.set_criteria(args.hq_pct, args.filter_hq, args.trim_hq,
-                           args.trim_5, args.min_len_pct,
-                           args.min_pct_hq_reads)
+def filter_trim_reads(r1, r2, paired_end, checkpoint=None):
+    """
+    Filter, trim and write the reads one at a time.
 
+    :param r1: The end 1 reads.
+    :param r2: The end 2 reads, or None for a single end run.
+    :param paired_end: True for a paired end run.
+    :param checkpoint: A Checkpoint to save as the run goes, or None.
+    :return: None
+    """
     r1_ok = False
 
     # If we don't have paired end reads, we just want the tests
@@ -577,6 +1835,9 @@ def main():
 
     # Loop over the whole file.  We'll exit this with a break.
     while True:
+        if checkpoint is not None and checkpoint.due(r1.total_reads):
+            checkpoint.save(r1, r2)
+
         # Do NOT move these into the if statement below; we need to
         # keep them in sync. If they are in the if, and r1 fails,
         # r2 will not be executed.
@@ -629,32 +1890,376 @@ def main():
         if paired_end:
             r2.write()
 
+
+def filter_trim_batch(r1, r2, paired_end, count):
+    """
+    Filter, trim and write the first count reads of the current
+    batches.
+
+    :param r1: The end 1 reads.
+    :param r2: The end 2 reads, or None for a single end run.
+    :param paired_end: True for a paired end run.
+    :param count: The number of reads to process.
+    :return: None
+    """
+    for n in xrange(count):
+        r1_ok = r1.batch_filter(n)
+        r2_ok = True
+        if paired_end:
+            r2_ok = r2.batch_filter(n)
+        if not (r1_ok and r2_ok):
+            # Filtering this read failed... Next!
+            continue
+
+        r1_ok = r1.batch_trim(n)
+        if paired_end:
+            r2_ok = r2.batch_trim(n)
+        if not (r1_ok and r2_ok):
+            # This read trimmed to be too short.
+            continue
+
+        r1.write()
+        if paired_end:
+            r2.write()
+
+
+def filter_trim_chunk(chunk):
+    """
+    Worker process entry point: filter and trim one chunk of reads.
+    The criteria were inherited from the main process when the pool
+    was created; the minimum trimmed length is passed in since it is
+    set by the first trimmed read.
+
+    :param chunk: A tuple (minimum trimmed length, number of reads to
+    process, end 1 reads, end 2 reads or None, whether to collect
+    histograms, whether the ends are written interleaved).
+    :return: A tuple of FastqShard.result() for end 1 and end 2 (None
+    for a single end run).
+    """
+    min_len, count, records1, records2, histograms, interleaved = chunk
+    FastqRead.min_len = min_len
+    s1 = FastqShard(records1, histograms)
+    s2 = None
+    if records2 is not None:
+        # Interleaved, end 2 writes to end 1's buffer, pair by pair.
+        s2 = FastqShard(records2, histograms, s1.of if interleaved else None)
+    filter_trim_batch(s1, s2, s2 is not None, count)
+    if s2 is None:
+        return s1.result(), None
+    return s1.result(), s2.result()
+
+
+def filter_trim_parallel(r1, r2, paired_end, chunk_size, processes,
+                         checkpoint=None):
+    """
+    Filter, trim and write the reads in chunks of chunk_size reads
+    per end, using a pool of worker processes.  This process reads
+    the chunks, keeping both ends in lockstep as filter_trim_reads()
+    does, and merges the results in the original order.
+
+    :param r1: The end 1 reads.
+    :param r2: The end 2 reads, or None for a single end run.
+    :param paired_end: True for a paired end run.
+    :param chunk_size: The number of reads per end in a chunk.
+    :param processes: The number of worker processes.
+    :param checkpoint: A Checkpoint to save as the run goes, or None.
+    :return: None
+    """
+    pool = multiprocessing.Pool(processes,
+                                DecompressedInput.close_inherited)
+    # Limit the chunks in flight, so that a slow writer doesn't let
+    # the whole input pile up in memory.
+    pending = collections.deque()
+
+    def merge_chunk():
+        s1, s2 = pending.popleft().get()
+        r1.merge(s1)
+        if paired_end:
+            r2.merge(s2)
+
+    try:
+        # Loop over the whole file.  We'll exit this with a break.
+        while True:
+            n1 = r1.read_batch(chunk_size)
+            n2 = n1
+            if paired_end:
+                n2 = r2.read_batch(chunk_size)
+            n = min(n1, n2)
+
+            if FastqRead.min_len is None:
+                # The minimum trimmed length is set from the first read
+                # trimmed.  Process chunks here until that happened, so
+                # every worker uses the same value.
+                r1.evaluate()
+                if paired_end:
+                    r2.evaluate()
+                filter_trim_batch(r1, r2, paired_end, n)
+            elif n:
+                records2 = None
+                if paired_end:
+                    records2 = r2.batch[0]
+                pending.append(pool.apply_async(
+                    filter_trim_chunk,
+                    ((FastqRead.min_len, n, r1.batch[0], records2,
+                      r1.histograms is not None,
+                      paired_end and r2.shared_output),)))
+                while len(pending) > 2 * processes:
+                    merge_chunk()
+
+            if n1 != n2:
+                # One file is exhausted. Must both end at the same read.
+                while pending:
+                    merge_chunk()
+                print >> sys.stderr, \
+                    'Input files {0} and {1} are different lengths.\n' \
+                    'Exiting.'.format(
+                        r1.get_filename(),
+                        r2.get_filename())
+                sys.exit(5)
+            if n1 < chunk_size:
+                # Both files are exhausted; move on to the next pair.
+                if not r1.next_file():
+                    # We've exhausted the list of input files.
+                    break
+                if paired_end:
+                    # Guaranteed to succeed: lists are equal length.
+                    r2.next_file()
+
+            if checkpoint is not None and checkpoint.due(r1.total_reads):
+                # Everything read must be written first.
+                while pending:
+                    merge_chunk()
+                checkpoint.save(r1, r2)
+
+        while pending:
+            merge_chunk()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def filter_trim_batches(r1, r2, paired_end, batch_size, checkpoint=None):
+    """
+    Filter, trim and write the reads batch_size at a time. Gives the
+    same output and statistics as filter_trim_reads(), in the same
+    order; only the per-base work is done for a whole batch at once.
+
+    :param r1: The end 1 reads.
+    :param r2: The end 2 reads, or None for a single end run.
+    :param paired_end: True for a paired end run.
+    :param batch_size: The number of reads per end in a batch.
+    :param checkpoint: A Checkpoint to save as the run goes, or None.
+    :return: None
+    """
+    # Loop over the whole file.  We'll exit this with a break.
+    while True:
+        n1 = r1.next_batch(batch_size)
+        n2 = n1
+        if paired_end:
+            n2 = r2.next_batch(batch_size)
+
+        # Process the reads both ends have, even if one end ran out
+        # early; the per-read path writes those before it stops.
+        filter_trim_batch(r1, r2, paired_end, min(n1, n2))
+
+        if n1 != n2:
+            # One file is exhausted. Must both end at the same read.
+            print >> sys.stderr, \
+                'Input files {0} and {1} are different lengths.\n' \
+                'Exiting.'.format(
+                    r1.get_filename(),
+                    r2.get_filename())
+            sys.exit(5)
+        if n1 < batch_size:
+            # Both files are exhausted; move on to the next pair.
+            if not r1.next_file():
+                # We've exhausted the list of input files.
+                break
+            if paired_end:
+                # Guaranteed to succeed: lists are equal length.
+                r2.next_file()
+
+        if checkpoint is not None and checkpoint.due(r1.total_reads):
+            checkpoint.save(r1, r2)
+
+
+def main():
+    start_time = datetime.datetime.now()
+    args = parse_args()
+
+    # If we are doing paired end processing, make sure that we have
+    # pairs (i.e., an even number of files, and split the list of
+    # files into end-specific lists.
+    num_fastqs = len(args.fastqs)
+    paired_end = ((num_fastqs != 1) and (not args.single_end))
+
+    if paired_end:
+        # Paired end; need to be an even number of fastqs.
+        if num_fastqs % 2 != 0:
+            print >> sys.stderr, 'Odd number of fastq files ({0}) in ' \
+                                 'paired-end mode. Exiting...'.format(
+                num_fastqs
+            )
+            sys.exit(4)
+
+        # Now split the lists:
+        e1_fastqs = args.fastqs[::2]
+        e2_fastqs = args.fastqs[1::2]
+    else:
+        # Make a copy.  We need the original later.
+        e1_fastqs = args.fastqs[:]
+        e2_fastqs = None
+
+    if args.phred == 'auto':
+        # Sample before the FastqReads start on the input lists.
+        sample = [e1_fastqs[0]]
+        if paired_end:
+            sample.append(e2_fastqs[0])
+        try:
+            phred_offset = QualityCriteria.detect_offset(sample)
+        except (IOError, OSError):
+            print >> sys.stderr, \
+                'Could not open "{0}". Exiting.'.format(sample)
+            sys.exit(1)
+        if phred_offset is None:
+            print >> sys.stderr, 'No reads to detect the quality ' \
+                                 'encoding from; using phred+33.'
+            phred_offset = 33
+        else:
+            print >> sys.stderr, 'Detected phred+{0} quality ' \
+                                 'encoding.'.format(phred_offset)
+    else:
+        phred_offset = int(args.phred)
+
+    checkpoint = None
+    state = None
+    if args.checkpoint > 0 or args.resume:
+        if args.fifo or args.interleaved == '-':
+            print >> sys.stderr, 'Checkpoints need regular output ' \
+                                 'files; not checkpointing.'
+        else:
+            checkpoint = Checkpoint(
+                (args.interleaved or
+                 FastqRead.output_name(e1_fastqs, args.odir, args.suffix,
+                                       args.compress)) + '.checkpoint',
+                args.checkpoint, args)
+            if args.resume:
+                state = checkpoint.load()
+                if state is None:
+                    print >> sys.stderr, 'No checkpoint found; starting ' \
+                                         'from the beginning.'
+    # Where to cut each output back to when resuming.
+    offsets = [None, None]
+    if state is not None:
+        offsets = [end['output_offset'] for end in state['ends']] + [None]
+
+    if args.fifo:
+        # Make all the pipes before opening any: opening one blocks
+        # until its reader opens it, and the reader may need to see
+        # the other one first.
+        if args.interleaved:
+            outputs = [args.interleaved]
+        else:
+            ends = [e1_fastqs]
+            if paired_end:
+                ends.append(e2_fastqs)
+            outputs = [FastqRead.output_name(fastqs, args.odir,
+                                             args.suffix, args.compress)
+                       for fastqs in ends]
+        for name in outputs:
+            if name == '-' or os.path.exists(name):
+                continue
+            try:
+                os.mkfifo(name)
+            except OSError:
+                print >> sys.stderr, \
+                    'Could not create "{0}". Exiting.'.format(name)
+                sys.exit(1)
+
+    # With --interleaved, both ends write to the same output, a pair
+    # at a time.
+    of = None
+    if args.interleaved:
+        of = FastqRead.create(args.interleaved, args.compress,
+                              args.compress_level, args.compress_threads,
+                              offsets[0])
+
+    r1 = FastqRead(e1_fastqs, args.odir, args.suffix, args.compress, args.compress_level, args.compress_threads,
+                   args.parallel_decompress, args.histograms, of, offsets[0])
+
+    # We may be processing single end reads.  Everything with r2 is
+    # conditional on having a second fastq.
+    r2 = None
+    if paired_end:
+        r2 = FastqRead(e2_fastqs, args.odir, args.suffix, args.compress, args.compress_level, args.compress_threads,
+                       args.parallel_decompress, args.histograms, of, offsets[1])
+
+    # Check if we want timestamps output to track progress
+    if args.timestamp:
+        r1.do_timestamp()
+
+    # The criteria are class members, not instance.
+    FastqRead.set_criteria(args.hq_pct, args.filter_hq, args.trim_hq,
+                           args.trim_5, args.min_len_pct,
+                           args.min_pct_hq_reads, phred_offset)
+
+    if state is not None:
+        checkpoint.restore(state, r1, r2)
+
+    if args.batch_size > 0 and numpy is None:
+        print >> sys.stderr, 'Could not import numpy; using per-read ' \
+                             'filtering.'
+    if args.processes > 1:
+        filter_trim_parallel(r1, r2, paired_end,
+                             args.batch_size or 10000, args.processes,
+                             checkpoint)
+    elif args.batch_size > 0 and numpy is not None:
+        filter_trim_batches(r1, r2, paired_end, args.batch_size,
+                            checkpoint)
+    else:
+        filter_trim_reads(r1, r2, paired_end, checkpoint)
+
     if paired_end:
         status = output_stats_paired(r1, r2, args, start_time)
         r2.close()
     else:
         status = output_stats_single(r1, args, start_time)
     r1.close()
+    if of is not None:
+        of.close()
+    if checkpoint is not None:
+        checkpoint.remove()
 
-    src1 = args.odir + os.path.split(args.fastqs[::2][0])[1] + '_filtered_trimmed'
-    # dest1 = args.fastqs[::2][1]
+    # Streamed reads were consumed as they were written; there are no
+    # read files to move into place.
+    streamed = args.interleaved or args.fifo
+
+    if not streamed:
+        src1 = r1.ofn_path
+        # dest1 = args.fastqs[::2][1]
+
+        if paired_end:
+            src2 = r2.ofn_path
+            # dest2 = args.fastqs[1::2][1]
+            print("[INFO] "+src1 + " " + src2)
+        else:
+            print("[INFO] "+src1)
 
     if paired_end:
-        src2 = args.odir + os.path.split(args.fastqs[1::2][0])[1] + '_filtered_trimmed'
-        # dest2 = args.fastqs[1::2][1]
-        print("[INFO] "+src1 + " " + src2)
+        stat_file = args.odir + os.path.split(args.fastqs[::2][0])[1] + "_" + \
+            os.path.split(args.fastqs[1::2][0])[1] + "_stat"
     else:
-        print("[INFO] "+src1)
+        stat_file = args.odir + os.path.split(args.fastqs[::2][0])[1] + "_stat"
 
     try:
-        shutil.move(src1, args.forward_sample_output)
-        if paired_end:
-            shutil.move(src2, args.reverse_sample_output)
-            shutil.move(
-                args.odir + os.path.split(args.fastqs[::2][0])[1] + "_" + os.path.split(args.fastqs[1::2][0])[1] + "_stat",
-                args.summary_stat_file)
-        else:
-            shutil.move(args.odir + os.path.split(args.fastqs[::2][0])[1] + "_stat", args.summary_stat_file)
+        if not streamed:
+            shutil.move(src1, args.forward_sample_output)
+            if paired_end:
+                shutil.move(src2, args.reverse_sample_output)
+        shutil.move(stat_file, args.summary_stat_file)
+        if args.histograms:
+            shutil.move(stat_file + '.json', args.summary_stat_file + '.json')
     except Exception as e:
         print('Error saving results to the file -> %s' % e)
         sys.exit(1)
@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+"""
+The cores and memory allocated to this job, for sizing the threads and
+memory of the tools it runs.
+
+Galaxy passes the number of cores in GALAXY_SLOTS, and the memory in
+GALAXY_MEMORY_MB, when its job runner is configured to.  A container
+or the cluster scheduler may limit the job further, with a cgroup CPU
+quota or memory limit, or with the CPU affinity of the process.  The
+smallest of these limits wins.
+
+The same module is in CTP_PDX/bin and JAX_RNA/rsem_alignment; keep
+the copies the same.
+"""
+from __future__ import division, print_function
+
+import multiprocessing
+import os
+
+CGROUP = '/sys/fs/cgroup'
+
+
+def read_file(name):
+    try:
+        with open(name) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def environment_int(name):
+    try:
+        value = int(os.environ[name])
+    except (KeyError, ValueError):
+        return None
+    if value > 0:
+        return value
+    return None
+
+
+def cgroup_cpus():
+    """
+    :return: The cgroup CPU quota in whole cores (at least 1), or None
+    if there is no quota.
+    """
+    # cgroup v2: "<quota> <period>", or "max <period>".
+    limit = read_file(os.path.join(CGROUP, 'cpu.max'))
+    if limit:
+        quota, period = (limit.split() + ['100000'])[:2]
+    else:
+        # cgroup v1.
+        quota = read_file(os.path.join(CGROUP, 'cpu', 'cpu.cfs_quota_us'))
+        period = read_file(os.path.join(CGROUP, 'cpu', 'cpu.cfs_period_us'))
+    try:
+        quota = int(quota)
+        period = int(period)
+    except (TypeError, ValueError):
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return max(1, quota // period)
+
+
+def affinity_cpus():
+    """
+    :return: The number of cores this process may run on.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return None
+
+
+def cpus():
+    """
+    :return: A tuple (number of cores, what limited it).
+    """
+    limits = [(environment_int('GALAXY_SLOTS'), 'GALAXY_SLOTS'),
+              (cgroup_cpus(), 'cgroup CPU quota'),
+              (affinity_cpus(), 'CPU affinity')]
+    limits = [limit for limit in limits if limit[0]]
+    if not limits:
+        return 1, 'default'
+    return min(limits, key=lambda limit: limit[0])
+
+
+def cgroup_memory_mb():
+    """
+    :return: The cgroup memory limit in MB, or None if there is none.
+    """
+    limit = read_file(os.path.join(CGROUP, 'memory.max'))
+    if limit is None:
+        limit = read_file(os.path.join(CGROUP, 'memory',
+                                       'memory.limit_in_bytes'))
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        # "max", or no cgroup.
+        return None
+    # An unlimited cgroup v1 reports a huge number; the physical
+    # memory limit covers that.
+    return limit // (1024 * 1024)
+
+
+def physical_memory_mb():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') \
+            // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def memory_mb():
+    """
+    :return: A tuple (memory in MB, what limited it).
+    """
+    limits = [(environment_int('GALAXY_MEMORY_MB'), 'GALAXY_MEMORY_MB'),
+              (cgroup_memory_mb(), 'cgroup memory limit'),
+              (physical_memory_mb(), 'physical memory')]
+    limits = [limit for limit in limits if limit[0]]
+    if not limits:
+        return 2048, 'default'
+    return min(limits, key=lambda limit: limit[0])
+
+
+def threads(requested=None):
+    """
+    :param requested: The number of threads asked for; None or 0 for
+    all the cores of the job.
+    :return: A tuple (number of threads, why), never more than the
+    cores of the job.
+    """
+    cores, source = cpus()
+    try:
+        requested = int(requested)
+    except (TypeError, ValueError):
+        requested = 0
+    if 0 < requested <= cores:
+        return requested, 'requested'
+    return cores, source
+
+
+def memory_per_thread(count, fraction, minimum_mb=256, maximum_mb=2048):
+    """
+    Share a fraction of the memory of the job among threads, e.g. for
+    samtools sort -m.
+
+    :param count: The number of threads.
+    :param fraction: The fraction of the memory they may use.
+    :param minimum_mb: The least to give each thread.
+    :param maximum_mb: The most to give each thread.
+    :return: The memory per thread, like "768M".
+    """
+    mb = memory_mb()[0]
+    per_thread = int(mb * fraction / max(1, count))
+    return '{0}M'.format(max(minimum_mb, min(maximum_mb, per_thread)))
+
+
+if __name__ == '__main__':
+    print('Cores: {0} ({1})'.format(*cpus()))
+    print('Memory: {0} MB ({1})'.format(*memory_mb()))
@@ -4,12 +4,18 @@ from __future__ import print_function
 """
 RSEM Alignment to transcriptome.
 Version: 1.3.0
+
+The number of threads is capped at the cores Galaxy allocated to the
+job; 0 uses them all.  The BAM sort memory per thread is sized to the
+memory of the job; see job_resources.py.
 """
 import sys
 import os
 import shutil
 import argparse
 
+import job_resources
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -27,6 +33,19 @@ def parse_args():
     return parser.parse_args()
 
 
+def allocate(requested):
+    """
+    The RSEM threads, up to the cores of the job, and the sort memory
+    per thread.  RSEM sorts the BAM after the alignment, so the sort can
+    have most of the memory.
+    """
+    threads, source = job_resources.threads(requested)
+    sort_memory = job_resources.memory_per_thread(threads, 0.75)
+    print("[INFO] Threads: " + str(threads) + " (" + source +
+          "), sort memory per thread: " + sort_memory)
+    return str(threads), sort_memory
+
+
 def main():
     # args = parse_args()
     sample_type = sys.argv[1]
@@ -37,12 +56,12 @@ def main():
         if sample_type == 'single_end':
             #sample_name = sys.argv[6]
             sample_name = "sample"
-            rsem_threads = sys.argv[7]
+            rsem_threads, sort_memory = allocate(sys.argv[7])
             rsem_stat = sys.argv[8]
             command = "rsem-calculate-expression -p " + rsem_threads + \
                       " --phred33-quals --seed-length " + sys.argv[2] + \
                       " --forward-prob " + sys.argv[3] + \
-                      " --sort-bam-memory-per-thread 2G " \
+                      " --sort-bam-memory-per-thread " + sort_memory + " " \
                       "--time " \
                       "--output-genome-bam " \
                       "--sort-bam-by-coordinate " \
@@ -53,12 +72,12 @@ def main():
         else:
             #sample_name = sys.argv[7]
             sample_name = "sample"
-            rsem_threads = sys.argv[8]
+            rsem_threads, sort_memory = allocate(sys.argv[8])
             rsem_stat = sys.argv[9]
             command = "rsem-calculate-expression -p " + rsem_threads + \
                       " --phred33-quals --seed-length " + sys.argv[2] + \
                       " --forward-prob " + sys.argv[3] + \
-                      " --sort-bam-memory-per-thread 2G " \
+                      " --sort-bam-memory-per-thread " + sort_memory + " " \
                       "--time " \
                       "--output-genome-bam " \
                       "--sort-bam-by-coordinate " \
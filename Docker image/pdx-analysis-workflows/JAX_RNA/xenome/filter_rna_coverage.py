@@ -3,17 +3,46 @@
 For determining whether we have enough data to make meaningful RNA expression
 estimations, we'll look at the number of human reads available after the
 Xenome step.
-Version: 1.1.0
+
+The tool waits for xenome classify itself to exit.  As a stall detector,
+it also watches its output files, with inotify if the inotify_simple
+module is installed, else by their size and modification time.  Once
+Xenome has written to one of them, if none of them is written for
+XENOME_STALL_SECONDS (default 300, 0 to disable) Xenome is taken to
+have hung after writing its output and is terminated.  Before its first
+write, while it loads its index, there is no limit.
+
+The reads of each class are then counted by counting the lines of the
+class files, all of them at once, both mates for paired data, by a pool
+of processes.
+Version: 1.2.0
 """
 
 from __future__ import print_function
 
 import argparse
-import datetime
 import os
 import subprocess
 import sys
 import time
+import multiprocessing
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# How often to check on Xenome, in seconds.
+POLL_SECONDS = 2
+
+# The delays of the sleep polling this tool used to do, for reporting
+# the time saved.
+OLD_DELAY_INIT = 180
+OLD_DELAY_NORMAL = 90
+OLD_STALL = 300
+
+# Read size for counting lines.
+COUNT_BLOCK = 4 * 1024 * 1024
 
 
 def parse_args():
@@ -61,16 +90,136 @@ def process_file(fn, minimum, multiple):
     return True
 
 
+class OutputActivity(object):
+    """
+    When the Xenome output files were last written.  The clock starts
+    at the first write that leaves one of them non-empty.
+    """
+    def __init__(self, names):
+        self.names = set(names)
+        self.last = None
+        self.state = self.stat()
+        self.inotify = None
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+                self.inotify.add_watch('.', flags.CREATE | flags.MODIFY |
+                                       flags.CLOSE_WRITE)
+            except OSError:
+                self.inotify = None
+
+    def stat(self):
+        state = []
+        for name in sorted(self.names):
+            try:
+                st = os.stat(name)
+                state.append((st.st_size, st.st_mtime))
+            except OSError:
+                state.append(None)
+        return state
+
+    def written(self):
+        """
+        :return: True if any of the files is not empty.
+        """
+        return any(st is not None and st[0] for st in self.stat())
+
+    def idle(self):
+        """
+        :return: The seconds since any of the files was last written, 0
+            if none has been written to yet.
+        """
+        now = time.time()
+        if self.inotify is not None:
+            changed = any(event.name in self.names
+                          for event in self.inotify.read(timeout=0))
+        else:
+            state = self.stat()
+            changed = state != self.state
+            self.state = state
+        if changed and (self.last is not None or self.written()):
+            self.last = now
+        if self.last is None:
+            return 0
+        return now - self.last
+
+    # End of class OutputActivity.
+
+
+def wait_for_xenome(sp, outputs, stall_seconds):
+    """
+    Wait for Xenome to exit, or terminate it if its outputs stall.
+    :param sp: The xenome classify process.
+    :param outputs: Its output files.
+    :param stall_seconds: How long the outputs may go unwritten after
+        the first write to them; 0 for no limit.
+    :return: The exit status, or None if Xenome was terminated.
+    """
+    activity = OutputActivity(outputs)
+    while True:
+        status = sp.poll()
+        if status is not None:
+            return status
+        idle = activity.idle()
+        if stall_seconds and idle > stall_seconds:
+            print("[INFO] No Xenome output for %d s. Going to kill the "
+                  "Xenome process." % idle)
+            sp.terminate()
+            sp.wait()
+            return None
+        time.sleep(POLL_SECONDS)
+
+
+def old_polling_seconds(last_write):
+    """
+    When the sleep polling this tool used to do would have noticed that
+    Xenome was done: at the first check, after 180 s and then every 90 s,
+    at least 5 minutes after the last write.
+    :param last_write: The seconds from the start to the last write to
+        the human reads.
+    """
+    waited = OLD_DELAY_INIT
+    while waited <= last_write + OLD_STALL:
+        waited += OLD_DELAY_NORMAL
+    return waited
+
+
+def count_lines(name):
+    """
+    Count the newlines in a file, as wc -l does.
+    """
+    lines = 0
+    with open(name, 'rb', 0) as f:
+        block = f.read(COUNT_BLOCK)
+        while block:
+            lines += block.count(b'\n')
+            block = f.read(COUNT_BLOCK)
+    return lines
+
+
+def count_all_lines(names):
+    """
+    Count the lines of the files, in parallel.
+    :return: A dictionary of the number of lines of each file.
+    """
+    pool = multiprocessing.Pool(min(len(names), multiprocessing.cpu_count()))
+    try:
+        return dict(zip(names, pool.map(count_lines, names)))
+    finally:
+        pool.close()
+        pool.join()
+
+
 def main():
     # args = parse_args()
     sample_type = sys.argv[1]
     interim_results_dir = '/galaxy/reference-data/'
     prefix_dir = interim_results_dir + "xenome/"
 
-    delay_init = 180
-    delay_normal = 90
-    initial = True
-    count = 0
+    try:
+        stall_seconds = int(os.environ.get('XENOME_STALL_SECONDS', OLD_STALL))
+    except ValueError:
+        stall_seconds = OLD_STALL
 
     # if os.path.exists(interim_results_dir + xenome_stat_file):
     #     os.remove(interim_results_dir + xenome_stat_file)
@@ -88,6 +237,7 @@ def main():
 
     print("[INFO] Sample Type is " + sample_type)
 
+    start = time.time()
     try:
         if sample_type == 'single_end':
             minimum_reads = int(sys.argv[4])
@@ -132,50 +282,45 @@ def main():
         neither_output = 'neither_1.fastq'
         ambiguous_output = 'ambiguous_1.fastq'
 
-    while count == 0:
-        if initial:
-            time.sleep(delay_init)
-            initial = False
-        else:
-            time.sleep(delay_normal)
+    outputs = [human_output, mouse_output, both_output, neither_output,
+               ambiguous_output]
+    if sample_type != 'single_end':
+        outputs += [name.replace('_1.', '_2.') for name in outputs]
+    status = wait_for_xenome(sp, outputs, stall_seconds)
+    finished = time.time() - start
+    if status:
+        print("Error executing  xenome classify -> exit status %d" % status)
+        sys.exit(1)
 
-        try:
-            modified_time = datetime.datetime.fromtimestamp(os.path.getmtime(human_output))
-            current_time = datetime.datetime.now()
-            back_time = current_time - datetime.timedelta(minutes=5)
-            print("[INFO] Current Time: %s Modified Time: %s Back Time: %s" % (current_time, modified_time, back_time))
-        except OSError:
-            modified_time = 0
+    try:
+        last_write = os.path.getmtime(human_output) - start
+        old = old_polling_seconds(last_write)
+        print("[INFO] Xenome was done after %d s; the sleep polling would "
+              "have waited %d s (%d s saved)." % (finished, old,
+                                                  old - finished))
+    except OSError:
+        pass
 
-        check_is_size_zero_bytes = os.stat(human_output).st_size
+    try:
+        lines = count_all_lines(outputs)
+    except (IOError, OSError) as e:
+        print('Error counting the Xenome output reads -> %s' % e)
+        sys.exit(1)
 
-        if check_is_size_zero_bytes == 0:
-            time.sleep(delay_normal)
-        else:
-            if modified_time < current_time - datetime.timedelta(minutes=5):
-                print("[INFO] Check is matched. Going to kill the Xenome process.")
-                sp.terminate()
-                count = 1
-
-    h1 = subprocess.Popen(['wc', '-l', human_output], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    h2 = subprocess.Popen(('cut', '-d', ' ', '-f', '1'), stdin=h1.stdout, stdout=subprocess.PIPE)
-    human = int(h2.communicate()[0]) / 4
-
-    m1 = subprocess.Popen(['wc', '-l', mouse_output], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    m2 = subprocess.Popen(('cut', '-d', ' ', '-f', '1'), stdin=m1.stdout, stdout=subprocess.PIPE)
-    mouse = int(m2.communicate()[0]) // 4
-
-    b1 = subprocess.Popen(['wc', '-l', both_output], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    b2 = subprocess.Popen(('cut', '-d', ' ', '-f', '1'), stdin=b1.stdout, stdout=subprocess.PIPE)
-    both = int(b2.communicate()[0]) / 4
-
-    n1 = subprocess.Popen(['wc', '-l', neither_output], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    n2 = subprocess.Popen(('cut', '-d', ' ', '-f', '1'), stdin=n1.stdout, stdout=subprocess.PIPE)
-    neither = int(n2.communicate()[0]) / 4
-
-    a1 = subprocess.Popen(['wc', '-l', ambiguous_output], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    a2 = subprocess.Popen(('cut', '-d', ' ', '-f', '1'), stdin=a1.stdout, stdout=subprocess.PIPE)
-    ambiguous = int(a2.communicate()[0]) / 4
+    human = lines[human_output] / 4
+    mouse = lines[mouse_output] // 4
+    both = lines[both_output] / 4
+    neither = lines[neither_output] / 4
+    ambiguous = lines[ambiguous_output] / 4
+
+    if sample_type != 'single_end':
+        # The table counts pairs by their first mates; the second mates
+        # should match.
+        for name in outputs[:5]:
+            mate = name.replace('_1.', '_2.')
+            if lines[mate] != lines[name]:
+                print("[WARNING] %s has %d reads but %s has %d." % (
+                    name, lines[name] // 4, mate, lines[mate] // 4))
 
     total = human + mouse + both + neither + ambiguous
 
@@ -0,0 +1,138 @@
+#! /usr/bin/env python3
+"""
+Regression checks for the multi-sample matrix mode of
+coveragecalculator.py (--matrix).
+
+Each case writes small per-base coverage files, runs
+coveragecalculator.py on them with the Python 2 it needs, and compares
+the exit status and the matrix with what is expected.  The exit status
+is 1 if any case fails.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(HERE)),
+                      'Docker image', 'pdx-analysis-workflows', 'CTP_PDX',
+                      'bin', 'coveragecalculator.py')
+
+# Targets (chr, start, stop, gene), sorted as the matrix mode needs.
+G1 = ('chr1', '100', '102', 'G1')
+G2 = ('chr2', '200', '202', 'G2')
+G3 = ('chr10', '300', '302', 'G3')
+G4 = ('chrX', '400', '402', 'G4')
+
+HEADER = 'chr\tstart\tstop\tGene name\t' \
+    'a_Mean_coverage\ta_Median_coverage\ta_fraction_ge_10x\t' \
+    'b_Mean_coverage\tb_Median_coverage\tb_fraction_ge_10x'
+NA = 'NA\tNA\tNA'
+
+
+def rows(target, coverages):
+    """
+    :return: The per-base rows of a target.
+    """
+    return [target + (str(int(target[1]) + i), str(coverage))
+            for i, coverage in enumerate(coverages)]
+
+
+def line(target, *samples):
+    return '\t'.join(target + samples)
+
+
+# name: (sample a rows, sample b rows, exit status, expected matrix)
+CASES = {
+    'same targets': (
+        rows(G1, [10, 20]) + rows(G2, [5, 5]),
+        rows(G1, [0, 10]) + rows(G2, [30, 30]),
+        0, [line(G1, '15.00\t15.0\t1.0000', '5.00\t5.0\t0.5000'),
+            line(G2, '5.00\t5.0\t0.0000', '30.00\t30.0\t1.0000')]),
+    # b lacks the leading targets of a.
+    'missing leading targets': (
+        rows(G1, [10]) + rows(G2, [10]) + rows(G3, [20]) + rows(G4, [1]),
+        rows(G3, [40]) + rows(G4, [2]),
+        0, [line(G1, '10.00\t10.0\t1.0000', NA),
+            line(G2, '10.00\t10.0\t1.0000', NA),
+            line(G3, '20.00\t20.0\t1.0000', '40.00\t40.0\t1.0000'),
+            line(G4, '1.00\t1.0\t0.0000', '2.00\t2.0\t0.0000')]),
+    # The same, the other way round.
+    'missing leading targets, swapped': (
+        rows(G3, [40]) + rows(G4, [2]),
+        rows(G1, [10]) + rows(G2, [10]) + rows(G3, [20]) + rows(G4, [1]),
+        0, [line(G1, NA, '10.00\t10.0\t1.0000'),
+            line(G2, NA, '10.00\t10.0\t1.0000'),
+            line(G3, '40.00\t40.0\t1.0000', '20.00\t20.0\t1.0000'),
+            line(G4, '2.00\t2.0\t0.0000', '1.00\t1.0\t0.0000')]),
+    'missing middle and trailing targets': (
+        rows(G1, [10]) + rows(G3, [20]),
+        rows(G2, [30]) + rows(G3, [40]) + rows(G4, [50]),
+        0, [line(G1, '10.00\t10.0\t1.0000', NA),
+            line(G2, NA, '30.00\t30.0\t1.0000'),
+            line(G3, '20.00\t20.0\t1.0000', '40.00\t40.0\t1.0000'),
+            line(G4, NA, '50.00\t50.0\t1.0000')]),
+    # chr10 before chr2 is not sorted; found after rows were written.
+    'unsorted': (
+        rows(G1, [1]) + rows(G3, [1]) + rows(G2, [1]),
+        rows(G1, [1]),
+        1, None),
+}
+
+
+def write_bed(name, bed_rows):
+    with open(name, 'w') as f:
+        for row in bed_rows:
+            f.write('\t'.join(row) + '\n')
+
+
+def check(python, name, case, directory):
+    """
+    :return: True if the case passed.
+    """
+    a_rows, b_rows, status, expected = case
+    a = os.path.join(directory, 'a.bed')
+    b = os.path.join(directory, 'b.bed')
+    matrix = os.path.join(directory, 'matrix.tsv')
+    write_bed(a, a_rows)
+    write_bed(b, b_rows)
+    if os.path.exists(matrix):
+        os.remove(matrix)
+    proc = subprocess.run([python, SCRIPT, '--matrix', matrix,
+                           '--thresholds', '10', a, b],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    problems = []
+    if proc.returncode != status:
+        problems.append('exit status {0}, expected {1}: {2}'.format(
+            proc.returncode, status, proc.stderr.strip()))
+    if expected is None:
+        if os.path.exists(matrix):
+            problems.append('a matrix was written')
+    else:
+        with open(matrix) as f:
+            got = f.read().splitlines()
+        if got != [HEADER] + expected:
+            problems.append('matrix differs:\n' + '\n'.join(got))
+    print('{0}: {1}'.format(name, 'FAILED ' + '; '.join(problems)
+                            if problems else 'ok'))
+    return not problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Regression checks for coveragecalculator.py --matrix.')
+    parser.add_argument('-p', '--python', default='python2',
+                        help='Python 2 interpreter to run '
+                             'coveragecalculator.py with [python2]')
+    args = parser.parse_args(argv)
+    passed = True
+    with tempfile.TemporaryDirectory() as directory:
+        for name in sorted(CASES):
+            passed &= check(args.python, name, CASES[name], directory)
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,287 @@
+#! /usr/bin/env python3
+"""
+Benchmark the filter/trim step (filter_trim.py) on synthetic reads.
+
+For each size, generate_fastq.py makes a reproducible pair of FASTQ
+files, kept in the work directory for later runs, and each
+filter_trim.py is run on them.  The JSON report records for each run
+the wall clock time, the reads (both ends) processed per second, the
+peak resident set size, and checksums of the outputs.  With --compare,
+the report is compared with an earlier one: the speed-up of each run
+is printed, and the exit status is 1 if any output changed.
+"""
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+
+import generate_fastq
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(os.path.dirname(HERE))
+WORKFLOWS = os.path.join(REPO, 'Docker image', 'pdx-analysis-workflows')
+SCRIPTS = [
+    os.path.join(WORKFLOWS, 'CTP_PDX', 'bin', 'filter_trim.py'),
+    os.path.join(WORKFLOWS, 'JAX_RNA', 'reads_quality', 'filter_trim.py'),
+]
+
+# Lines of the statistics file that differ from run to run.
+VARIABLE_STATS = ('Run start time', 'Run end time')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark filter_trim.py on synthetic reads.')
+    parser.add_argument('-s', '--script', action='append',
+                        help='A filter_trim.py to benchmark; may be '
+                             'repeated [both copies in this repository]')
+    parser.add_argument('-p', '--python', default='python2',
+                        help='Python 2 interpreter to run filter_trim.py '
+                             'with [python2]')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000],
+                        help='Numbers of read pairs to run with '
+                             '[10000 100000 1000000]')
+    parser.add_argument('-a', '--args', default='',
+                        help='Extra filter_trim.py arguments, e.g. '
+                             '--args="-b 10000 -P 4"')
+    parser.add_argument('-g', '--generator-args', default='',
+                        help='generate_fastq.py arguments for the read '
+                             'length, quality profile, low quality '
+                             'fraction, compression and seed, e.g. '
+                             '--generator-args="-l 100 -c gzip"')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='Run each benchmark this many times and keep '
+                             'the fastest [1]')
+    parser.add_argument('-w', '--workdir', default='benchmark_work',
+                        help='Directory for the generated inputs and the '
+                             'outputs [benchmark_work]')
+    parser.add_argument('-o', '--output',
+                        default='filter_trim_benchmark.json',
+                        help='The JSON report [filter_trim_benchmark.json]')
+    parser.add_argument('-c', '--compare', metavar='REPORT',
+                        help='An earlier report to compare with')
+    return parser.parse_args(argv)
+
+
+def label(script):
+    """
+    :return: A short name for a script: its path in the repository.
+    """
+    path = os.path.relpath(os.path.abspath(script), WORKFLOWS)
+    if path.startswith(os.pardir):
+        return script
+    return path
+
+
+def make_inputs(workdir, size, generator_args):
+    """
+    Generate the input files for one size, unless they were made
+    already with the same arguments.
+
+    :return: The input file names.
+    """
+    directory = os.path.join(workdir, 'inputs-{0}'.format(size))
+    argv = shlex.split(generator_args) + [
+        '--reads', str(size), '--prefix', os.path.join(directory, 'bench')]
+    args = generate_fastq.parse_args(argv)
+    names = generate_fastq.file_names(args.prefix, args.compress,
+                                      args.single)
+    stamp = os.path.join(directory, 'arguments.json')
+    try:
+        with open(stamp) as f:
+            if json.load(f) == vars(args) and \
+                    all(os.path.exists(name) for name in names):
+                return names
+    except (IOError, ValueError):
+        pass
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    print('Generating {0} reads in {1}'.format(size, directory),
+          file=sys.stderr)
+    generate_fastq.generate(args)
+    with open(stamp, 'w') as f:
+        json.dump(vars(args), f)
+    return names
+
+
+def script_arguments(python, script):
+    """
+    The JAX copy of filter_trim.py moves its outputs to names given on
+    the command line; give it some.
+
+    :return: The arguments the script needs besides the common ones.
+    """
+    usage = subprocess.run([python, script, '--help'],
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                           universal_newlines=True).stdout
+    if '--summary_stat_file' in usage:
+        return ['-11', 'forward.fastq', '-12', 'reverse.fastq',
+                '-ssf', 'stats.txt']
+    return []
+
+
+def checksum(name):
+    """
+    MD5 of an output file.  Compressed files are checksummed
+    decompressed, and the statistics file without its times, so that
+    only changes to the results show.
+    """
+    md5 = hashlib.md5()
+    with open(name, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    if compressed:
+        with gzip.open(name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                md5.update(block)
+    elif name.endswith('_stat') or os.path.basename(name) == 'stats.txt':
+        with open(name, 'rb') as f:
+            for line in f:
+                # The decompression rates at the end are timings too.
+                if line.startswith(b'Input decompression'):
+                    break
+                if not line.decode().startswith(VARIABLE_STATS):
+                    md5.update(line)
+    else:
+        with open(name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                md5.update(block)
+    return md5.hexdigest()
+
+
+def run(python, script, extra, inputs, directory):
+    """
+    Run filter_trim.py once in an empty directory.
+
+    :return: A tuple (seconds, peak RSS in KiB, exit status).
+    """
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    command = [python, script, '-d', './'] + extra + \
+        [os.path.abspath(name) for name in inputs]
+    start = time.perf_counter()
+    with open(os.path.join(directory, 'stderr.log'), 'w') as log:
+        proc = subprocess.Popen(command, cwd=directory,
+                                stdout=subprocess.DEVNULL, stderr=log)
+        # wait4() gives the resources of this child alone; ru_maxrss
+        # covers its worker processes too, as it waits for them.
+        _, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.perf_counter() - start
+    if os.WIFSIGNALED(status):
+        status = -os.WTERMSIG(status)
+    else:
+        status = os.WEXITSTATUS(status)
+    return seconds, usage.ru_maxrss, status
+
+
+def benchmark(args):
+    """
+    :return: The report.
+    """
+    scripts = args.script or SCRIPTS
+    extra = shlex.split(args.args)
+    version = subprocess.run([args.python, '-V'], stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT,
+                             universal_newlines=True).stdout.strip()
+    report = {
+        'created': datetime.datetime.now().isoformat(),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'python': version,
+        'filter_trim_args': extra,
+        'generator_args': shlex.split(args.generator_args),
+        'runs': [],
+    }
+    for size in args.sizes:
+        inputs = make_inputs(args.workdir, size, args.generator_args)
+        for script in scripts:
+            directory = os.path.join(
+                args.workdir, 'run-{0}-{1}'.format(
+                    label(script).replace(os.sep, '_'), size))
+            command = script_arguments(args.python, script) + extra
+            best = None
+            peak_rss = 0
+            for _ in range(args.repeat):
+                seconds, rss, status = run(args.python, script, command,
+                                           inputs, directory)
+                peak_rss = max(peak_rss, rss)
+                if best is None or seconds < best:
+                    best = seconds
+            reads = size * len(inputs)
+            checksums = {}
+            for name in sorted(os.listdir(directory)):
+                if name != 'stderr.log':
+                    checksums[name] = checksum(os.path.join(directory, name))
+            result = {
+                'script': label(script),
+                'size': size,
+                'reads': reads,
+                'seconds': round(best, 3),
+                'reads_per_second': round(reads / best, 1),
+                'peak_rss_kb': peak_rss,
+                'exit_status': status,
+                'checksums': checksums,
+            }
+            report['runs'].append(result)
+            print('{script}\t{size}\t{seconds}s\t{reads_per_second} '
+                  'reads/s\t{peak_rss_kb} KiB\texit {exit_status}'.format(
+                      **result), file=sys.stderr)
+    return report
+
+
+def compare(old, new):
+    """
+    Print the speed-up and memory of each run in new against the same
+    script and size in old.
+
+    :return: True if all the outputs are the same.
+    """
+    same = True
+    earlier = dict(((r['script'], r['size']), r) for r in old['runs'])
+    print('Script\tSize\tReads/s before\tReads/s after\tSpeed-up\t'
+          'Peak RSS KiB before\tPeak RSS KiB after\tOutputs')
+    for r in new['runs']:
+        o = earlier.get((r['script'], r['size']))
+        if o is None:
+            print('{0}\t{1}\tnot in the earlier report'.format(
+                r['script'], r['size']))
+            continue
+        outputs = 'same'
+        if o['checksums'] != r['checksums'] or \
+                o['exit_status'] != r['exit_status']:
+            outputs = 'DIFFERENT'
+            same = False
+        print('{0}\t{1}\t{2}\t{3}\t{4:.2f}\t{5}\t{6}\t{7}'.format(
+            r['script'], r['size'], o['reads_per_second'],
+            r['reads_per_second'],
+            r['reads_per_second'] / o['reads_per_second'],
+            o['peak_rss_kb'], r['peak_rss_kb'], outputs))
+    return same
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = benchmark(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+        f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            if not compare(json.load(f), report):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
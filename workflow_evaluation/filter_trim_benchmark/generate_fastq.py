@@ -0,0 +1,150 @@
+#! /usr/bin/env python3
+"""
+Generate reproducible synthetic FASTQ files for benchmarking the
+filter/trim step (filter_trim.py).
+
+The same seed and options always give byte-identical files, including
+gzip and bzip2 output.  Read 1 and read 2 of a pair share the read
+number in their names, in the Casava 1.8 format.
+
+Quality profile: the mean quality of each cycle falls linearly from
+--quality-start at the first cycle to --quality-end at the last one,
+and each base varies around it by up to --quality-spread.  A fraction
+of the reads (--low-quality-fraction) has its mean lowered by
+--low-quality-drop, so that they fail the filter.  Bases whose quality
+ends up at 2 are called N.
+"""
+import argparse
+import bz2
+import gzip
+import random
+import sys
+
+# Phred+33 encoding, as filter_trim.py expects.
+OFFSET = 33
+MIN_QUALITY = 2
+MAX_QUALITY = 41
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Generate reproducible synthetic FASTQ files.')
+    parser.add_argument('-n', '--reads', type=int, default=100000,
+                        help='Number of reads (pairs) [100000]')
+    parser.add_argument('-l', '--read-length', type=int, default=150,
+                        help='Read length [150]')
+    parser.add_argument('--quality-start', type=int, default=40,
+                        help='Mean quality of the first cycle [40]')
+    parser.add_argument('--quality-end', type=int, default=28,
+                        help='Mean quality of the last cycle [28]')
+    parser.add_argument('--quality-spread', type=int, default=6,
+                        help='Maximum variation of a base around the mean '
+                             'of its cycle [6]')
+    parser.add_argument('--low-quality-fraction', type=float, default=0.2,
+                        help='Fraction of reads with lowered quality [0.2]')
+    parser.add_argument('--low-quality-drop', type=int, default=15,
+                        help='How far the quality of those reads is '
+                             'lowered [15]')
+    parser.add_argument('-c', '--compress', choices=['none', 'gzip', 'bz2'],
+                        default='none', help='Compression of the files '
+                                             '[none]')
+    parser.add_argument('-s', '--seed', type=int, default=1,
+                        help='Random seed [1]')
+    parser.add_argument('--single', action='store_true',
+                        help='Write read 1 only')
+    parser.add_argument('-o', '--prefix', default='synthetic',
+                        help='Output file prefix; the files are '
+                             'PREFIX_R1.fastq[.gz|.bz2] and '
+                             'PREFIX_R2.fastq[.gz|.bz2] [synthetic]')
+    return parser.parse_args(argv)
+
+
+def file_names(prefix, compress, single=False):
+    """
+    :return: The names of the files generate() writes.
+    """
+    ext = {'none': '', 'gzip': '.gz', 'bz2': '.bz2'}[compress]
+    ends = ['R1'] if single else ['R1', 'R2']
+    return ['{0}_{1}.fastq{2}'.format(prefix, end, ext) for end in ends]
+
+
+def open_output(name, compress):
+    if compress == 'gzip':
+        # A fixed time stamp keeps the file reproducible.
+        return gzip.GzipFile(name, 'wb', compresslevel=6, mtime=0)
+    if compress == 'bz2':
+        return bz2.BZ2File(name, 'wb')
+    return open(name, 'wb')
+
+
+# Maps random bytes to bases.
+BASES = bytes(b'ACGT'[i % 4] for i in range(256))
+
+
+def random_bytes(rng, n):
+    return rng.getrandbits(8 * n).to_bytes(n, 'little')
+
+
+def generate(args):
+    """
+    Write the files described by args.
+
+    :return: The names of the files written.
+    """
+    rng = random.Random(args.seed)
+    length = args.read_length
+    step = 0.0
+    if length > 1:
+        step = float(args.quality_end - args.quality_start) / (length - 1)
+    means = [int(round(args.quality_start + step * i))
+             for i in range(length)]
+    span = 2 * args.quality_spread + 1
+    min_char = MIN_QUALITY + OFFSET
+    max_char = MAX_QUALITY + OFFSET
+    # The quality characters of a read are its cycle means, lowered by
+    # the spread (and the drop for low quality reads), plus a random
+    # 0 to span - 1 per base, clamped.  Each byte stays below 256, so
+    # the additions can be done as one big integer addition.
+    noise = bytes(i % span for i in range(256))
+    clamp = bytes(min(max_char, max(min_char, i)) for i in range(256))
+    lowest = {}
+    for drop in (0, args.low_quality_drop):
+        lowest[drop] = int.from_bytes(bytes(
+            max(0, mean - drop - args.quality_spread + OFFSET)
+            for mean in means), 'little')
+
+    names = file_names(args.prefix, args.compress, args.single)
+    outputs = [open_output(name, args.compress) for name in names]
+    try:
+        for n in range(args.reads):
+            drop = 0
+            if rng.random() < args.low_quality_fraction:
+                drop = args.low_quality_drop
+            for end, out in enumerate(outputs):
+                qual = int.from_bytes(random_bytes(rng, length).translate(
+                    noise), 'little') + lowest[drop]
+                qual = qual.to_bytes(length, 'little').translate(clamp)
+                bases = random_bytes(rng, length).translate(BASES)
+                if min_char in qual:
+                    bases = bytes(ord('N') if q == min_char else b
+                                  for b, q in zip(bases, qual))
+                name = '@SYN:1:FC0001:1:{0}:{1}:{2} {3}:N:0:ACGTAC\n'
+                name = name.format(1101 + n // 1000000, n % 1000000 // 1000,
+                                   n % 1000, end + 1)
+                out.write(name.encode('ascii'))
+                out.write(bases + b'\n+\n' + qual + b'\n')
+    finally:
+        for out in outputs:
+            out.close()
+    return names
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    for name in generate(args):
+        print(name)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())